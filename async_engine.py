@@ -0,0 +1,369 @@
+#!/usr/bin/python3
+import os
+import json
+import random
+import signal
+import asyncio
+import logging
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import RotatingFileHandler
+import aiohttp
+import redis
+import redis.asyncio as aioredis
+from dotenv import load_dotenv
+import device_store
+import event_codec
+import event_rules
+import metrics
+import mra_client
+import stream_consumer
+from device_cache import DeviceCache
+from s3_archiver import S3BatchArchiver
+from mra_client import TokenManager, make_token_cache
+from stream_consumer import (FileCheckpoint, PendingMessages, RECONNECT_BACKOFF_BASE, RECONNECT_BACKOFF_CAP,
+                             CHECKPOINT_INTERVAL)
+from upload_pool import UploadPool, make_s3_client
+
+# Runs the event streams of several Lookout tenants concurrently in one process.
+# All tenants share one KeyDB connection pool, one HTTP connection pool and one S3
+# upload pool; each tenant has its own token, checkpoint and archive prefix, and a
+# failure in one tenant's stream never affects the others.
+
+# Load environment variables
+load_dotenv('production.env')
+
+# Configuration
+LOOKOUT_API_URL = os.getenv('LOOKOUT_API_URL', 'https://api.lookout.com')
+TOKEN_URL = f'{LOOKOUT_API_URL}/oauth2/token'
+EVENTS_STREAM_URL = f'{LOOKOUT_API_URL}/mra/stream/v2/events'
+KEYDB_HOST = os.getenv('KEYDB_HOST', 'localhost')
+KEYDB_PORT = int(os.getenv('KEYDB_PORT', 6379))
+KEYDB_MAX_CONNECTIONS = int(os.getenv('KEYDB_MAX_CONNECTIONS', 32))
+S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME')
+S3_REGION = os.getenv('S3_REGION', 'us-east-1')
+TENANTS_FILE = os.getenv('TENANTS_FILE', 'tenants.json')
+DEFAULT_EVENT_TYPES = 'THREAT,DEVICE,AUDIT'
+STREAM_READ_TIMEOUT = 90  # seconds without data (heartbeats included) before reconnecting
+SSE_MAX_LINE = int(os.getenv('SSE_MAX_LINE', 32 * 1024 * 1024))  # bytes; longer messages are skipped
+
+# Logging configuration
+LOG_FILE = 'async_engine.log'
+MAX_LOG_SIZE = 5 * 1024 * 1024  # 5 MB
+BACKUP_COUNT = 3
+
+logger = logging.getLogger(__name__)
+
+# Engine metrics, served on /metrics with --metrics-port (or METRICS_PORT)
+EVENTS_PROCESSED = metrics.Counter('events_processed_total', 'Stream events processed, by tenant and event type',
+                                   ['tenant', 'type'])
+STREAM_RECONNECTS = metrics.Counter('tenant_stream_reconnects_total', 'Reconnections to a tenant event stream', ['tenant'])
+KEYDB_SECONDS = metrics.Histogram('keydb_request_seconds', 'Latency of KeyDB device lookups, by operation', ['op'])
+# stream_consumer's counters belong to its synchronous consumer, which the engine does not use
+metrics.unregister(stream_consumer.STREAM_MESSAGES, stream_consumer.STREAM_RECONNECTS, stream_consumer.STREAM_ERRORS)
+
+SSEEvent = namedtuple('SSEEvent', ['id', 'event', 'data'])
+Tenant = namedtuple('Tenant', ['name', 'application_key', 'event_types', 's3_prefix', 'checkpoint', 'rules'])
+
+
+# Function to load the tenant list from the JSON configuration file
+# Each entry needs a "name" and either "application_key" or "application_key_env".
+def load_tenants(path):
+    with open(path) as f:
+        entries = json.load(f)
+    tenants = []
+    for entry in entries:
+        name = entry['name']
+        application_key = entry.get('application_key') or os.getenv(entry.get('application_key_env', ''))
+        if not application_key:
+            raise ValueError(f"No application key configured for tenant {name}")
+        tenants.append(Tenant(
+            name=name,
+            application_key=application_key,
+            event_types=entry.get('event_types', DEFAULT_EVENT_TYPES),
+            s3_prefix=entry.get('s3_prefix', f'{name}/'),
+            checkpoint=entry.get('checkpoint', f'stream-{name}.checkpoint'),
+            rules=entry.get('rules'),
+        ))
+    return tenants
+
+
+# Function to split an SSE byte stream into lines (without the line ending)
+# A line longer than max_line is not buffered: None is yielded in its place.
+async def sse_lines(content, max_line=SSE_MAX_LINE):
+    buffer = bytearray()
+    too_long = False
+    async for chunk in content.iter_any():
+        start = 0
+        while True:
+            end = chunk.find(b'\n', start)
+            if end < 0:
+                if not too_long:
+                    buffer += chunk[start:]
+                    if len(buffer) > max_line:
+                        too_long = True
+                        buffer.clear()
+                break
+            if not too_long:
+                buffer += chunk[start:end]
+            if too_long or len(buffer) > max_line:
+                yield None
+            else:
+                yield bytes(buffer.rstrip(b'\r'))
+            buffer.clear()
+            too_long = False
+            start = end + 1
+
+
+# Function to parse an SSE byte stream into events (data is kept as bytes)
+# The data of a message with a line over max_line is None: the message is still yielded,
+# with its id, so the caller can skip it and move on.
+async def sse_events(content, max_line=SSE_MAX_LINE):
+    event_id = event_name = None
+    data = []
+    too_long = False
+    async for line in sse_lines(content, max_line):
+        if line is None:
+            too_long = True
+            continue
+        if not line:
+            if too_long:
+                yield SSEEvent(event_id, event_name or 'message', None)
+            elif data:
+                yield SSEEvent(event_id, event_name or 'message', b'\n'.join(data))
+            event_name = None
+            data = []
+            too_long = False
+            continue
+        if line.startswith(b':'):
+            continue
+        field, _, value = line.partition(b':')
+        if value.startswith(b' '):
+            value = value[1:]
+        if field == b'data':
+            data.append(value)
+        elif field == b'event':
+            event_name = value.decode('utf-8')
+        elif field == b'id':
+            event_id = value.decode('utf-8')
+
+
+# One tenant's stream: token, checkpoint and archive are per tenant
+class TenantStream:
+    def __init__(self, tenant, session, r, device_cache, archiver, token_cache=None, archive_executor=None):
+        self.tenant = tenant
+        self.session = session
+        self.r = r
+        self.device_cache = device_cache
+        self.archiver = archiver
+        self.archive_executor = archive_executor
+        self.token_manager = TokenManager(tenant.application_key, TOKEN_URL, cache=token_cache)
+        self.checkpoint = FileCheckpoint(tenant.checkpoint)
+        self.pending = PendingMessages()  # the checkpoint only moves past messages stored in S3
+        self.rules = event_rules.load_rules(tenant.rules, types=tenant.event_types)
+        self.log = logging.getLogger(f'{__name__}.{tenant.name}')
+
+    # Function to resolve devices not already in the shared cache with one MGET
+    async def resolve_devices(self, guids):
+        found, missing = self.device_cache.lookup_many(guids)
+        if missing:
+            start = asyncio.get_running_loop().time()
+            raws = await self.r.mget(missing)
+            KEYDB_SECONDS.observe(asyncio.get_running_loop().time() - start, op='mget')
+            loaded = device_store.decode_devices(missing, raws)
+            for guid in missing:
+                self.device_cache.put(guid, loaded[guid])
+                found[guid] = loaded[guid]
+        return found
+
+    # Function to apply a DEVICE event to KeyDB and the shared cache; returns the device GUID
+    async def apply_device_event(self, event):
+        guid = device_store.device_event_guid(event)
+        if not guid:
+            return None
+        if event.get('change_type') == 'DELETED':
+            await self.r.delete(guid)
+        else:
+            try:
+                existing = device_store.decode_device(await self.r.get(guid))
+            except ValueError:
+                existing = None
+            await self.r.set(guid, device_store.encode_device(device_store.merge_device_event(existing, event)))
+        self.device_cache.invalidate(guid)
+        return guid
+
+    # Function to hand a payload's events to the archiver and the rule sinks
+    def archive(self, archived):
+        for event_type, created_time, line, route, on_stored in archived:
+            if route.archive:
+                self.archiver.add_raw(event_type, created_time, line, route_prefix=route.prefix, on_stored=on_stored)
+            if route.sink:
+                self.rules.sink(route).write(line)
+
+    async def process_payload(self, records, ticket):
+        archived = []
+        routes = [self.rules.route(record) for record in records]
+        devices = await self.resolve_devices([record.actor_guid for record, route in zip(records, routes)
+                                              if record.actor_guid and route.enrich])
+        for record, route in zip(records, routes):
+            if route.action == event_rules.DROP:
+                continue
+            if record.type == 'DEVICE':
+                guid = await self.apply_device_event(record.event)
+                if guid in devices:
+                    # Later events of this payload are enriched with the updated device
+                    devices.update(await self.resolve_devices([guid]))
+            enrichment = device_store.enrichment_fields(devices.get(record.actor_guid) if route.enrich else None)
+            EVENTS_PROCESSED.inc(tenant=self.tenant.name, type=record.type)
+            if route.archive or route.sink:
+                on_stored = ticket.hold() if route.archive else None
+                archived.append((record.type, record.created_time, record.raw_with_enrichment(enrichment),
+                                 route, on_stored))
+        if archived:
+            # A full batch is gzipped and waits for room in the upload queue (e.g. while S3
+            # is down), and sinks write files: do that on a thread, so only this tenant's
+            # stream waits
+            await asyncio.get_running_loop().run_in_executor(self.archive_executor, self.archive, archived)
+
+    # Function to save the checkpoint if more messages are stored since the last save
+    def save_checkpoint(self, saved_event_id):
+        done_event_id = self.pending.acknowledged()
+        if done_event_id and done_event_id != saved_event_id:
+            self.checkpoint.save(done_event_id)
+            return done_event_id
+        return saved_event_id
+
+    # Function to consume this tenant's stream forever, reconnecting with backoff
+    async def run(self):
+        last_event_id = self.checkpoint.load()
+        saved_event_id = last_event_id
+        loop = asyncio.get_running_loop()
+        last_saved = loop.time()
+        failures = 0
+        while True:
+            server_delay = None
+            try:
+                token = await asyncio.to_thread(self.token_manager.get)
+                headers = {'Authorization': f'Bearer {token}', 'Accept': 'text/event-stream'}
+                if last_event_id:
+                    headers['Last-Event-ID'] = last_event_id
+                params = {'types': self.rules.server_types()}
+                timeout = aiohttp.ClientTimeout(total=None, sock_read=STREAM_READ_TIMEOUT)
+                async with self.session.get(EVENTS_STREAM_URL, headers=headers, params=params, timeout=timeout) as response:
+                    if response.status == 401:
+                        self.token_manager.invalidate()
+                    elif response.status in mra_client.RETRY_STATUSES:
+                        server_delay = mra_client.retry_after(response)
+                    response.raise_for_status()
+                    async for event in sse_events(response.content):
+                        if event.event == 'events' and event.data is None:
+                            # Reconnecting would get the same message again: skip it
+                            self.log.error(f"Skipping message {event.id}: a line is longer than SSE_MAX_LINE "
+                                           f"({SSE_MAX_LINE} bytes)")
+                            self.pending.begin(event.id).done()
+                        elif event.event == 'events':
+                            failures = 0
+                            ticket = self.pending.begin(event.id)
+                            try:
+                                records = event_codec.decode_payload(event.data)
+                            except event_codec.DecodeError as e:
+                                self.log.error(f"Error decoding JSON: {str(e)}")
+                            else:
+                                await self.process_payload(records, ticket)
+                            finally:
+                                # A message that failed is requested again on reconnect, as
+                                # last_event_id only moves past processed messages
+                                ticket.done()
+                        elif event.event != 'heartbeat':
+                            self.log.warning(f"Unknown event received: {event}")
+                        if event.id:
+                            last_event_id = event.id
+                        if loop.time() - last_saved >= CHECKPOINT_INTERVAL:
+                            saved_event_id, last_saved = self.save_checkpoint(saved_event_id), loop.time()
+                        if self.token_manager.remaining() <= 0:
+                            self.log.info("Access token about to expire, reconnecting with a new token")
+                            break
+                    else:
+                        self.log.warning("Event stream closed by server")
+                        failures += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Isolate failures: log and retry this tenant only
+                failures += 1
+                self.log.error(f"Event stream error: {str(e)}")
+            finally:
+                saved_event_id, last_saved = self.save_checkpoint(saved_event_id), loop.time()
+            STREAM_RECONNECTS.inc(tenant=self.tenant.name)
+            if failures:
+                delay = random.uniform(0, min(RECONNECT_BACKOFF_CAP, RECONNECT_BACKOFF_BASE * 2 ** failures))
+                if server_delay is not None:
+                    delay = max(delay, server_delay)  # the server's Retry-After
+                self.log.info(f"Reconnecting to event stream in {delay:.1f}s (attempt {failures})")
+                await asyncio.sleep(delay)
+
+
+# Function to run every tenant stream until cancelled (SIGTERM/SIGINT)
+async def run_tenants(tenants, upload_pool):
+    r = aioredis.Redis(host=KEYDB_HOST, port=KEYDB_PORT, decode_responses=True,
+                       max_connections=KEYDB_MAX_CONNECTIONS)
+    device_cache = DeviceCache(None)
+    # Tokens are fetched on worker threads, so a cache in KeyDB needs a synchronous client
+    token_cache = make_token_cache(redis.StrictRedis(host=KEYDB_HOST, port=KEYDB_PORT, decode_responses=True))
+    archivers = [S3BatchArchiver(upload_pool, key_prefix=tenant.s3_prefix) for tenant in tenants]
+    # One thread per tenant, so a tenant blocked on a full upload queue never delays another
+    archive_executor = ThreadPoolExecutor(max_workers=max(1, len(tenants)), thread_name_prefix='archive')
+    connector = aiohttp.TCPConnector(limit=0, keepalive_timeout=60)
+    loop = asyncio.get_running_loop()
+    streams = []
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            tasks = []
+            for tenant, archiver in zip(tenants, archivers):
+                archiver.start()
+                stream = TenantStream(tenant, session, r, device_cache, archiver, token_cache, archive_executor)
+                streams.append(stream)
+                tasks.append(asyncio.create_task(stream.run(), name=f'tenant-{tenant.name}'))
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, lambda: [task.cancel() for task in tasks])
+            logger.info(f"Streaming events for {len(tasks)} tenants")
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        archive_executor.shutdown()
+        for archiver in archivers:
+            archiver.close()
+        upload_pool.wait_idle()
+        for stream in streams:
+            stream.save_checkpoint(None)
+        for stream in streams:
+            stream.rules.close()
+        await r.aclose()
+        logger.info(f"Device cache stats: {device_cache.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream events for several Lookout tenants in one process")
+    parser.add_argument('--tenants', default=TENANTS_FILE, help="path to the tenant configuration (JSON)")
+    parser.add_argument('--metrics-port', type=int, default=metrics.METRICS_PORT,
+                        help="serve Prometheus metrics on this local port (0 disables)")
+    args = parser.parse_args()
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    handler = RotatingFileHandler(LOG_FILE, maxBytes=MAX_LOG_SIZE, backupCount=BACKUP_COUNT)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    root_logger.addHandler(handler)
+
+    if not S3_BUCKET_NAME:
+        logger.error("S3_BUCKET_NAME is missing in environment variables.")
+        raise ValueError("S3_BUCKET_NAME is missing in environment variables.")
+
+    tenants = load_tenants(args.tenants)
+    metrics.start_http_server(args.metrics_port)
+    upload_pool = UploadPool(make_s3_client(S3_REGION), S3_BUCKET_NAME)
+    upload_pool.start()
+    try:
+        asyncio.run(run_tenants(tenants, upload_pool))
+    finally:
+        upload_pool.close()
@@ -0,0 +1,284 @@
+import os
+import gzip
+import time
+import argparse
+import threading
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+from dotenv import load_dotenv
+import device_store
+import event_codec
+import s3_archiver
+from device_cache import DeviceCache
+
+# Load environment variables
+load_dotenv('production.env')
+
+# Configuration
+KEYDB_HOST = os.getenv('KEYDB_HOST', 'localhost')
+KEYDB_PORT = int(os.getenv('KEYDB_PORT', 6379))
+S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME')
+S3_REGION = os.getenv('S3_REGION', 'us-east-1')
+BACKFILL_WORKERS = int(os.getenv('BACKFILL_WORKERS', 16))  # objects processed concurrently
+BACKFILL_RATE = float(os.getenv('BACKFILL_RATE', 0))  # objects per second, 0 = unlimited
+BACKFILL_STATE = os.getenv('BACKFILL_STATE', 'backfill.state')
+BACKFILL_PROGRESS_INTERVAL = 10  # seconds between progress lines
+EVENT_TYPES = 'THREAT,DEVICE,AUDIT'
+
+
+# Spaces out calls to acquire() so they happen at most rate times per second across threads
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# Function to get the day prefix an archived object was listed under: <day prefix>hour=HH/...
+# for batches, <day prefix><rest of created_time>_<actor guid>.json for legacy objects
+def day_prefix_of(key):
+    head, sep, _ = key.rpartition('hour=')
+    if sep:
+        return head
+    directory, _, name = key.rpartition('/')
+    return f"{directory}/{name[:10]}"
+
+
+# Progress of a backfill in an append-only file, so an interrupted run resumes where it
+# stopped: "O <key>" for every finished object, "P <prefix>" once all objects of a prefix
+# are finished (its object lines are then no longer kept in memory).
+class BackfillState:
+    def __init__(self, path):
+        self.path = path
+        self.prefixes = set()
+        self.objects = set()
+        try:
+            with open(path) as f:
+                for line in f:
+                    kind, _, name = line.rstrip('\n').partition(' ')
+                    (self.prefixes if kind == 'P' else self.objects).add(name)
+        except FileNotFoundError:
+            pass
+        self.objects = {key for key in self.objects if day_prefix_of(key) not in self.prefixes}
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def _append(self, kind, name):
+        with self._lock:
+            self._file.write(f"{kind} {name}\n")
+            self._file.flush()
+
+    def object_done(self, key):
+        self._append('O', key)
+
+    def prefix_done(self, prefix):
+        self._append('P', prefix)
+
+    def close(self):
+        self._file.close()
+
+
+# Function to tell whether an archived event is missing enrichment it could have
+def needs_enrichment(event, refresh=False):
+    if not (event.get('actor') or {}).get('guid'):
+        return False
+    if refresh:
+        return True
+    enrichment = event.get('enrichment') or {}
+    return not all(enrichment.get(field) for field in ('email', 'device_model', 'platform'))
+
+
+# Function to re-enrich the events (JSON lines) of one batch; returns (lines, events changed)
+# Every device the batch needs is resolved up front through the cache, so a batch costs at
+# most one pipelined MGET round trip. Undecodable lines are kept as they are.
+def enrich_lines(lines, device_cache, refresh=False):
+    events = []
+    for line in lines:
+        try:
+            events.append(event_codec.loads(line))
+        except ValueError:
+            events.append(None)
+    pending = [e for e in events if isinstance(e, dict) and needs_enrichment(e, refresh)]
+    devices = device_cache.get_many([e['actor']['guid'] for e in pending])
+    changed = 0
+    for event in pending:
+        device = devices.get(event['actor']['guid'])
+        if device is None:
+            continue
+        enrichment = device_store.enrichment_fields(device)
+        if enrichment != event.get('enrichment'):
+            event['enrichment'] = enrichment
+            changed += 1
+    if not changed:
+        return lines, 0
+    return [line if event is None else event_codec.dumps(event) for line, event in zip(lines, events)], changed
+
+
+# Re-enriches archived events in S3 against KeyDB, on a pool of worker threads: the
+# batches, and the per-event objects written before batching (legacy objects).
+# Objects are rewritten in place when an event changed, or with output_prefix a complete,
+# corrected copy of the archive is written under that prefix.
+class Backfill:
+    def __init__(self, s3_client, bucket, device_cache, state, workers=BACKFILL_WORKERS, rate=BACKFILL_RATE,
+                 output_prefix='', refresh=False, dry_run=False):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.device_cache = device_cache
+        self.state = state
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.output_prefix = output_prefix
+        self.refresh = refresh
+        self.dry_run = dry_run
+        self._lock = threading.Lock()
+        self._remaining = {}  # prefix -> [objects not finished yet, objects failed]
+        self.stats = {'objects': 0, 'rewritten': 0, 'events': 0, 'enriched': 0, 'failed': 0, 'skipped': 0}
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self.stats[name] += value
+
+    # Re-enrich one archived object, rewriting or copying it as needed
+    def process_object(self, key):
+        self.limiter.acquire()
+        lines = s3_archiver.read_events(self.s3_client, self.bucket, key)
+        new_lines, changed = enrich_lines(lines, self.device_cache, self.refresh)
+        target = self.output_prefix + key
+        if changed and not self.dry_run:
+            if key.endswith('.ndjson.gz'):
+                body = gzip.compress(b''.join(line + b'\n' for line in new_lines))
+                self.s3_client.put_object(Bucket=self.bucket, Key=target, Body=body, **s3_archiver.BATCH_PUT_ARGS)
+            else:
+                self.s3_client.put_object(Bucket=self.bucket, Key=target, Body=new_lines[0],
+                                          ContentType='application/json')
+        elif self.output_prefix and not self.dry_run:
+            self.s3_client.copy_object(Bucket=self.bucket, Key=target, CopySource={'Bucket': self.bucket, 'Key': key})
+        self._count(objects=1, rewritten=1 if changed else 0, events=len(lines), enriched=changed)
+
+    def _run_object(self, prefix, key, slots):
+        failed = 0
+        try:
+            self.process_object(key)
+            if not self.dry_run:
+                self.state.object_done(key)
+        except Exception as e:
+            failed = 1
+            self._count(failed=1)
+            print(f"Error backfilling {key}: {str(e)}")
+        finally:
+            slots.release()
+            self._finish(prefix, failed)
+
+    # Count one finished object of a prefix; the prefix is done when none remain and none failed
+    def _finish(self, prefix, failed):
+        with self._lock:
+            remaining = self._remaining[prefix]
+            remaining[0] -= 1
+            remaining[1] += failed
+            done = remaining[0] == 0 and remaining[1] == 0
+        if done and not self.dry_run:
+            self.state.prefix_done(prefix)
+
+    # Process every object under the prefixes; objects of different prefixes run concurrently
+    def run(self, prefixes):
+        slots = threading.BoundedSemaphore(self.workers * 4)  # bounds the objects queued ahead
+        stop = threading.Event()
+        threading.Thread(target=self._report, args=(stop,), daemon=True).start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='backfill') as pool:
+                for prefix in prefixes:
+                    if prefix in self.state.prefixes:
+                        continue
+                    with self._lock:
+                        self._remaining[prefix] = [1, 0]  # 1 until the prefix is fully listed
+                    # Batch day prefixes end with "/", legacy ones with the date
+                    list_keys = s3_archiver.list_prefix_keys if prefix.endswith('/') else s3_archiver.list_legacy_keys
+                    for key in list_keys(self.s3_client, self.bucket, prefix):
+                        if key in self.state.objects:
+                            self._count(skipped=1)
+                            continue
+                        slots.acquire()
+                        with self._lock:
+                            self._remaining[prefix][0] += 1
+                        pool.submit(self._run_object, prefix, key, slots)
+                    self._finish(prefix, 0)
+        finally:
+            stop.set()
+        return self.stats
+
+    def _report(self, stop):
+        start = time.monotonic()
+        while not stop.wait(BACKFILL_PROGRESS_INTERVAL):
+            print(self.progress(time.monotonic() - start))
+
+    def progress(self, elapsed):
+        with self._lock:
+            stats = dict(self.stats)
+        rate = stats['objects'] / elapsed if elapsed > 0 else 0.0
+        return (f"Objects: {stats['objects']} ({rate:.0f}/s), rewritten: {stats['rewritten']}, "
+                f"events: {stats['events']}, enriched: {stats['enriched']}, failed: {stats['failed']}, "
+                f"already done: {stats['skipped']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-enrich archived events in S3 with device details from KeyDB")
+    parser.add_argument('--start', type=date.fromisoformat, required=True, help="first day to backfill (YYYY-MM-DD)")
+    parser.add_argument('--end', type=date.fromisoformat, help="last day to backfill (default: --start)")
+    parser.add_argument('--types', default=EVENT_TYPES, help="comma-separated event types to backfill")
+    parser.add_argument('--bucket', default=S3_BUCKET_NAME, help="bucket holding the archived events")
+    parser.add_argument('--key-prefix', default='', help="extra prefix of the archived events (a rule's prefix)")
+    parser.add_argument('--output-prefix', default='',
+                        help="write a corrected copy of every object under this prefix instead of rewriting in place")
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS, help="objects processed concurrently")
+    parser.add_argument('--rate', type=float, default=BACKFILL_RATE, help="objects per second (0 = unlimited)")
+    parser.add_argument('--state', default=BACKFILL_STATE, help="progress file used to resume an interrupted run")
+    parser.add_argument('--refresh', action='store_true',
+                        help="re-enrich every event, not only those with missing enrichment fields")
+    parser.add_argument('--dry-run', action='store_true', help="count the events that would change, write nothing")
+    parser.add_argument('--no-legacy', action='store_true',
+                        help="skip the per-event objects written before batching (events/{type}/{created_time}_...)")
+    args = parser.parse_args()
+
+    if not args.bucket:
+        raise SystemExit("S3_BUCKET_NAME is missing in environment variables.")
+    output_prefix = args.output_prefix.strip('/') + '/' if args.output_prefix.strip('/') else ''
+
+    r = device_store.open_store(KEYDB_HOST, KEYDB_PORT)
+    device_cache = DeviceCache(lambda guid: device_store.get_device(r, guid),
+                               bulk_loader=lambda guids: device_store.get_devices_pipelined(r, guids))
+    # Adaptive retries back off client-side when S3 throttles the bucket
+    s3_client = boto3.client('s3', region_name=S3_REGION, config=Config(
+        max_pool_connections=max(10, args.workers), retries={'max_attempts': 10, 'mode': 'adaptive'}))
+
+    prefixes = []
+    for event_type in [t.strip() for t in args.types.split(',') if t.strip()]:
+        prefixes += s3_archiver.day_prefixes(event_type, args.start, args.end or args.start, args.key_prefix)
+        if not args.no_legacy:
+            prefixes += s3_archiver.legacy_day_prefixes(event_type, args.start, args.end or args.start,
+                                                        args.key_prefix)
+
+    state = BackfillState(args.state)
+    backfill = Backfill(s3_client, args.bucket, device_cache, state, workers=args.workers, rate=args.rate,
+                        output_prefix=output_prefix, refresh=args.refresh, dry_run=args.dry_run)
+    start = time.monotonic()
+    try:
+        stats = backfill.run(prefixes)
+    finally:
+        state.close()
+    print(backfill.progress(time.monotonic() - start))
+    print(f"Device cache stats: {device_cache.stats()}")
+    if stats['failed']:
+        raise SystemExit(f"{stats['failed']} objects failed, run the same command again to retry them")
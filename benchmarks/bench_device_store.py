@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import device_store
+from mock_mra import make_device
+
+# Benchmark device lookups against the configured KeyDB and a local SQLite device file
+# (DEVICE_STORE=<path>): single GET and the per-payload MGET the viewers issue.
+# Writes synthetic devices into the configured KeyDB, so point it at a disposable instance.
+
+
+# Function to time lookups; returns µs per call of the fastest round
+def time_lookups(lookup, batches, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for batch in batches:
+            lookup(batch)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(batches) * 1e6
+
+
+# Function to load the devices into a store and time its lookups
+def bench_store(name, store, devices, args):
+    start = time.perf_counter()
+    for i in range(0, len(devices), 1000):
+        device_store.put_devices(store, devices[i:i + 1000])
+    load_seconds = time.perf_counter() - start
+    guids = [device['guid'] for device in devices]
+    singles = [random.choice(guids) for _ in range(args.lookups)]
+    batches = [random.sample(guids, args.batch_size) for _ in range(max(1, args.lookups // args.batch_size))]
+    get_us = time_lookups(lambda guid: device_store.get_device(store, guid), singles, args.rounds)
+    mget_us = time_lookups(lambda batch: device_store.get_devices(store, batch), batches, args.rounds)
+    print(f"{name:<8} load {len(devices) / load_seconds:>9.0f} devices/sec   "
+          f"GET {get_us:>7.1f} µs   MGET x{args.batch_size} {mget_us:>8.1f} µs")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark device lookups: KeyDB vs a local SQLite device file")
+    parser.add_argument('--devices', type=int, default=100000, help="number of synthetic devices")
+    parser.add_argument('--lookups', type=int, default=5000, help="lookups per round")
+    parser.add_argument('--batch-size', type=int, default=20, help="GUIDs per MGET (devices referenced by a payload)")
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--skip-keydb', action='store_true', help="only benchmark the SQLite file")
+    args = parser.parse_args()
+
+    devices = [make_device(oid) for oid in range(1, args.devices + 1)]
+    if not args.skip_keydb:
+        bench_store('keydb', device_store.open_store(os.getenv('KEYDB_HOST', 'localhost'),
+                                                     int(os.getenv('KEYDB_PORT', 6379)), 'keydb'), devices, args)
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'devices.db')
+        bench_store('sqlite', device_store.open_store(None, None, path), devices, args)
+        # Opening an existing file is what a viewer does at startup
+        start = time.perf_counter()
+        store = device_store.open_store(None, None, path)
+        device_store.get_device(store, devices[0]['guid'])
+        print(f"sqlite   open + first lookup {(time.perf_counter() - start) * 1000:.2f} ms "
+              f"({os.path.getsize(path) / 1e6:.1f} MB file)")
@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+import argparse
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_mra import start_mock_server, server_url
+
+# Benchmark load_data.get_devices_data against the local mock API and a local Redis/KeyDB.
+# Writes synthetic devices into the configured KeyDB, so point it at a disposable instance.
+
+
+# Function to emulate the original loader: 100-device pages, one SET per device and a new
+# connection per request
+def baseline_load(load_data, access_token):
+    import device_store
+    headers = {'Authorization': f'Bearer {access_token}', 'Accept': 'application/json'}
+    params = {'limit': 100}
+    total = 0
+    while True:
+        response = requests.get(load_data.DEVICES_URL, headers=headers, params=params)
+        response.raise_for_status()
+        devices = response.json().get('devices', [])
+        for device in devices:
+            device_store.put_device(load_data.r, device)
+        total += len(devices)
+        if len(devices) < 100:
+            return total
+        params['oid'] = devices[-1]['oid']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark load_data.py against a local mock MRA API")
+    parser.add_argument('--devices', type=int, default=50000, help="number of synthetic devices")
+    parser.add_argument('--baseline', action='store_true', help="also time the original serial loader")
+    args = parser.parse_args()
+
+    server = start_mock_server(device_count=args.devices)
+    os.environ['LOOKOUT_API_URL'] = server_url(server)
+    os.environ.setdefault('APPLICATION_KEY', 'benchmark')
+
+    import load_data
+
+    token_manager = load_data.mra_client.TokenManager(load_data.APPLICATION_KEY, load_data.TOKEN_URL)
+
+    start = time.monotonic()
+    total = load_data.get_devices_data(token_manager)
+    elapsed = time.monotonic() - start
+    print(f"load_data: {total} devices in {elapsed:.2f}s ({total / elapsed:.0f} devices/sec)")
+
+    if args.baseline:
+        start = time.monotonic()
+        total = baseline_load(load_data, token_manager.get())
+        elapsed = time.monotonic() - start
+        print(f"baseline:  {total} devices in {elapsed:.2f}s ({total / elapsed:.0f} devices/sec)")
+
+    server.shutdown()
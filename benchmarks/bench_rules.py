@@ -0,0 +1,79 @@
+import os
+import sys
+import json
+import time
+import argparse
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import event_codec
+import event_rules
+from mock_mra import DEFAULT_MIX, make_event, load_fixtures, parse_mix
+
+# Benchmark the cost of evaluating event_rules per event, on events replayed from the
+# recorded fixtures. Every round decodes fresh records, so rules on non-header fields
+# pay for the full event decode just as they do in the viewers.
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'events.jsonl')
+RULES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'rules.example.json')
+
+# Rule sets compared: no rules, rules on header fields only, and the example configuration
+HEADER_ONLY = {'rules': [
+    {'name': 'drop-audits', 'match': {'type': 'AUDIT', '!target.type': ['DEVICE']}, 'action': 'drop'},
+    {'name': 'device-updates', 'match': {'type': 'DEVICE', 'change_type': ['UPDATED']}, 'prefix': 'devices'},
+]}
+
+
+# Function to time decoding (and optionally routing) every payload
+# Returns ns per event of the fastest round, which is the least disturbed by other load.
+def time_rounds(payloads, rules, events_per_round, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter_ns()
+        for payload in payloads:
+            records = event_codec.decode_payload(payload)
+            if rules is not None:
+                for record in records:
+                    rules.route(record)
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / events_per_round
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark event rule evaluation cost per event")
+    parser.add_argument('--events', type=int, default=10000, help="events per round")
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=10, help="events per stream payload")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="event-type mix, e.g. THREAT=2,DEVICE=1,AUDIT=1")
+    parser.add_argument('--fixtures', default=FIXTURES, help="recorded events to replay (JSON lines)")
+    parser.add_argument('--rules', default=RULES, help="rules file to benchmark")
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.fixtures)
+    event_types = parse_mix(args.mix)
+    events = [make_event(seq, 1000, event_types, fixtures) for seq in range(args.events)]
+    payloads = [json.dumps({'events': events[i:i + args.batch_size]}).encode('utf-8')
+                for i in range(0, len(events), args.batch_size)]
+
+    with open(args.rules) as f:
+        example = json.load(f)
+    example.get('default', {}).pop('sink', None)
+    for rule in example.get('rules', []):
+        rule.pop('sink', None)  # measure evaluation, not file writes
+
+    time_rounds(payloads, None, len(events), 1)  # warm-up
+    baseline = time_rounds(payloads, None, len(events), args.rounds)
+    print(f"JSON decoder: {'msgspec' if event_codec.msgspec else 'orjson' if event_codec.orjson else 'json'}")
+    print(f"{'rule set':<24} {'ns/event':>10} {'rules ns/event':>15}")
+    print(f"{'decode only':<24} {baseline:>10.0f} {'-':>15}")
+    for name, config in (('no rules', {}), ('header fields only', HEADER_ONLY),
+                         (os.path.basename(args.rules), example)):
+        rules = event_rules.RuleSet(config)
+        cost = time_rounds(payloads, rules, len(events), args.rounds)
+        print(f"{name:<24} {cost:>10.0f} {cost - baseline:>15.0f}")
+
+    rules = event_rules.RuleSet(example)
+    routed = Counter(rules.route(record).name for payload in payloads for record in event_codec.decode_payload(payload))
+    print("Routes: " + ', '.join(f"{name}={count}" for name, count in routed.most_common()))
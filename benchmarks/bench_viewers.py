@@ -0,0 +1,297 @@
+import os
+import re
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mock_mra import DEFAULT_MIX, start_mock_server, configure_server, server_url, make_device
+
+# End-to-end benchmark of the viewers and load_data.py against the local mock MRA API,
+# a local Redis/KeyDB and a moto S3 server (pip install "moto[server]").
+# Every target runs as its own process; the report shows events (or devices) per second,
+# p50/p99 latency from an event's created_time to the moment the viewer emitted it, and
+# the process's peak RSS. Synthetic devices are written into the configured KeyDB.
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'events.jsonl')
+S3_BUCKET = 'benchmark'
+
+# name -> (script, extra arguments, where processed events are observed)
+VIEWERS = {
+    'raw_viewer': ('raw_viewer.py', [], 'stdout'),
+    'improvedviewer': ('improvedviewer.py', [], 'stdout'),
+    'improvedviewer-S3': ('improvedviewer-S3.py', [], 'stdout'),
+    'improvedviewer-S3 --headless': ('improvedviewer-S3.py', ['--headless'], 'log'),
+    'improvedviewer-S3 --headless --workers 4': ('improvedviewer-S3.py', ['--headless', '--workers', '4'], 'log'),
+}
+NEEDS_S3 = ('improvedviewer-S3.py',)
+
+CREATED_TIME_STDOUT = re.compile(r'Created Time: (\S+)')
+CREATED_TIME_LOG = re.compile(r'"ts":([0-9.]+).*"created_time":"([^"]+)"')
+STORED_DEVICES = re.compile(r'Stored (\d+) devices in ([0-9.]+) seconds')
+PAGE_LATENCY = re.compile(r'Page fetch latency: n=\d+ avg=[0-9.]+ms p50=([0-9.]+)ms p99=([0-9.]+)ms')
+
+
+# Collects (observed at, created_time) latencies of processed events
+class LatencyRecorder:
+    def __init__(self):
+        self.latencies = []
+        self.first = self.last = None
+        self._lock = threading.Lock()
+        self.done = threading.Event()
+        self.expected = None
+
+    def record(self, created_time, observed_at=None):
+        observed_at = observed_at or time.time()
+        try:
+            latency = observed_at - datetime.fromisoformat(created_time).timestamp()
+        except ValueError:
+            return
+        with self._lock:
+            self.latencies.append(latency)
+            self.first = self.first or observed_at
+            self.last = observed_at
+            if self.expected and len(self.latencies) >= self.expected:
+                self.done.set()
+
+    def result(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+        count = len(latencies)
+        elapsed = (self.last - self.first) if count > 1 else 0.0
+        return {
+            'count': count,
+            'rate': count / elapsed if elapsed > 0 else 0.0,
+            'p50': percentile(latencies, 0.50),
+            'p99': percentile(latencies, 0.99),
+        }
+
+
+# Function to pick a percentile from sorted values (nearest rank)
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# Function to read a viewer's stdout and record every event it prints
+def watch_stdout(stream, recorder):
+    for line in stream:
+        match = CREATED_TIME_STDOUT.search(line)
+        if match:
+            recorder.record(match.group(1))
+
+
+# Function to follow a (rotating) JSON log file and record every structured event line
+def watch_log(path, recorder, stop):
+    f = None
+    partial = ''
+    while True:
+        if f is None:
+            try:
+                f = open(path)
+            except FileNotFoundError:
+                if stop.wait(0.05):
+                    return
+                continue
+        line = f.readline()
+        if line:
+            partial += line
+            if partial.endswith('\n'):
+                match = CREATED_TIME_LOG.search(partial)
+                if match:
+                    recorder.record(match.group(2), float(match.group(1)))
+                partial = ''
+            continue
+        # End of file: switch to the new file after a rotation, or wait for more lines
+        try:
+            rotated = os.stat(path).st_ino != os.fstat(f.fileno()).st_ino
+        except FileNotFoundError:
+            rotated = False
+        if rotated:
+            f.close()
+            f = None
+        elif stop.wait(0.05):
+            f.close()
+            return
+
+
+# Tracks a child's peak RSS (MB) from /proc/<pid>/status while it runs (Linux only).
+# ru_maxrss is not used: it also counts the benchmark process the child was forked from.
+class RssSampler:
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def sample(self):
+        try:
+            with open(f'/proc/{self.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        self.peak = max(self.peak or 0, int(line.split()[1]) / 1024)
+        except (FileNotFoundError, ProcessLookupError):
+            pass
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.peak
+
+
+# Function to build the environment of a benchmarked process
+def target_env(mock, workdir, s3_endpoint):
+    env = dict(os.environ)
+    env.update({
+        'LOOKOUT_API_URL': server_url(mock),
+        'APPLICATION_KEY': 'benchmark',
+        'STREAM_CHECKPOINT': os.path.join(workdir, 'stream.checkpoint'),
+        'PYTHONUNBUFFERED': '1',
+    })
+    if s3_endpoint:
+        env.update({
+            'S3_BUCKET_NAME': S3_BUCKET,
+            'AWS_ENDPOINT_URL_S3': s3_endpoint,
+            'AWS_ACCESS_KEY_ID': 'benchmark',
+            'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        })
+    return env
+
+
+# Function to run one viewer until it has emitted every event (or the timeout expires)
+def run_viewer(name, mock, args, s3_endpoint):
+    script, extra_args, source = VIEWERS[name]
+    configure_server(mock, args.devices, max_events=args.events, rate=args.rate,
+                     batch_size=args.batch_size, mix=args.mix, fixtures=args.fixtures)
+    recorder = LatencyRecorder()
+    recorder.expected = args.events
+    with tempfile.TemporaryDirectory() as workdir:
+        stop = threading.Event()
+        proc = subprocess.Popen([sys.executable, os.path.join(ROOT, script)] + extra_args,
+                                cwd=workdir, env=target_env(mock, workdir, s3_endpoint),
+                                stdout=subprocess.PIPE if source == 'stdout' else subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL, text=True)
+        if source == 'stdout':
+            watcher = threading.Thread(target=watch_stdout, args=(proc.stdout, recorder), daemon=True)
+        else:
+            watcher = threading.Thread(target=watch_log, args=(os.path.join(workdir, 'improvedviewer.log'),
+                                                               recorder, stop), daemon=True)
+        watcher.start()
+        rss = RssSampler(proc.pid)
+        deadline = time.monotonic() + args.timeout
+        while not recorder.done.wait(0.2):
+            if proc.poll() is not None or time.monotonic() > deadline:
+                break
+        if proc.poll() is None:
+            rss.sample()
+            proc.terminate()  # SIGTERM: the S3 viewer flushes its batches before exiting
+        proc.wait()
+        stop.set()
+        watcher.join(timeout=5)
+    return dict(recorder.result(), rss=rss.stop())
+
+
+# Function to run load_data.py against the mock devices API
+def run_load_data(mock, args):
+    configure_server(mock, args.devices)
+    with tempfile.TemporaryDirectory() as workdir:
+        proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'load_data.py')], cwd=workdir,
+                                env=target_env(mock, workdir, None), stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, text=True)
+        rss = RssSampler(proc.pid, interval=0.05)
+        output = proc.stdout.read()
+        proc.wait()
+    stored = STORED_DEVICES.search(output)
+    latency = PAGE_LATENCY.search(output)
+    count, elapsed = (int(stored.group(1)), float(stored.group(2))) if stored else (0, 0.0)
+    return {
+        'count': count,
+        'rate': count / elapsed if elapsed > 0 else 0.0,
+        'p50': float(latency.group(1)) / 1000 if latency else 0.0,
+        'p99': float(latency.group(2)) / 1000 if latency else 0.0,
+        'rss': rss.stop(),
+    }
+
+
+# Function to start a moto S3 server with the benchmark bucket; returns (server, endpoint)
+def start_s3():
+    try:
+        import boto3
+        from moto.server import ThreadedMotoServer
+    except ImportError as e:
+        print(f"moto server unavailable ({str(e)}), skipping the S3 viewer")
+        return None, None
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    endpoint = f'http://{host}:{port}'
+    s3 = boto3.client('s3', region_name='us-east-1', endpoint_url=endpoint,
+                      aws_access_key_id='benchmark', aws_secret_access_key='benchmark')
+    s3.create_bucket(Bucket=S3_BUCKET)
+    return server, endpoint
+
+
+# Function to write the synthetic devices the stream refers to into KeyDB
+def seed_devices(device_count):
+    import redis
+    import device_store
+    r = redis.StrictRedis(host=os.getenv('KEYDB_HOST', 'localhost'), port=int(os.getenv('KEYDB_PORT', 6379)),
+                          decode_responses=True)
+    for first in range(1, device_count + 1, 1000):
+        device_store.put_devices(r, [make_device(oid) for oid in range(first, min(first + 1000, device_count + 1))])
+
+
+def print_result(name, result, unit):
+    rss = f"{result['rss']:.0f}" if result['rss'] is not None else 'n/a'
+    print(f"{name:<30} {result['count']:>9} {result['rate']:>10.0f} {unit:<8} "
+          f"{result['p50'] * 1000:>9.1f} {result['p99'] * 1000:>9.1f} {rss:>9}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the viewers and load_data.py against a local mock MRA API")
+    parser.add_argument('--events', type=int, default=20000, help="events streamed to each viewer")
+    parser.add_argument('--devices', type=int, default=10000, help="number of synthetic devices")
+    parser.add_argument('--rate', type=float, default=0, help="SSE messages per second (0 = unthrottled)")
+    parser.add_argument('--batch-size', type=int, default=10, help="events per SSE message")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="event-type mix, e.g. THREAT=2,DEVICE=1,AUDIT=1")
+    parser.add_argument('--fixtures', default=FIXTURES, help="recorded events to replay (JSON lines)")
+    parser.add_argument('--viewers', default=','.join(VIEWERS), help="comma-separated viewers to run")
+    parser.add_argument('--skip-load-data', action='store_true', help="do not benchmark load_data.py")
+    parser.add_argument('--timeout', type=float, default=300, help="seconds allowed per viewer")
+    args = parser.parse_args()
+
+    mock = start_mock_server(device_count=args.devices)
+    seed_devices(args.devices)
+    viewers = [name.strip() for name in args.viewers.split(',') if name.strip()]
+    s3_server, s3_endpoint = None, None
+    if any(VIEWERS[name][0] in NEEDS_S3 for name in viewers):
+        s3_server, s3_endpoint = start_s3()
+
+    print(f"{'target':<30} {'count':>9} {'per sec':>10} {'':<8} {'p50 ms':>9} {'p99 ms':>9} {'RSS MB':>9}")
+    try:
+        for name in viewers:
+            if VIEWERS[name][0] in NEEDS_S3 and not s3_endpoint:
+                continue
+            print_result(name, run_viewer(name, mock, args, s3_endpoint), 'events')
+        if not args.skip_load_data:
+            # Latency for load_data is the devices page request latency
+            print_result('load_data', run_load_data(mock, args), 'devices')
+    finally:
+        if s3_server:
+            s3_server.stop()
+        mock.shutdown()
@@ -0,0 +1,63 @@
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import event_codec
+
+# Checks that decode_payload (the msgspec path when msgspec is installed) gives the same
+# records as decoding each event fully, for events whose fields have unexpected types or
+# that already carry an "enrichment" member, and that raw_with_enrichment gives the event
+# with exactly one, replaced, "enrichment" member.
+
+FIELDS = ('id', 'type', 'change_type', 'created_time', 'actor_guid', 'actor_type', 'target_guid', 'target_type')
+ENRICHMENT = {'email': 'user@example.com', 'device_model': 'Pixel 8', 'platform': 'ANDROID'}
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'mixed_types.jsonl')
+
+
+# Function to decode a JSON object, rejecting duplicate members (json keeps the last one)
+def unique_members(pairs):
+    names = [name for name, _ in pairs]
+    if len(names) != len(set(names)):
+        raise ValueError(f"duplicate members in {names}")
+    return dict(pairs)
+
+
+# Function to list the differences between a decoded record and the fully decoded event
+def check_event(line, record):
+    event = json.loads(line)
+    expected = event_codec.EventRecord.from_event(event)
+    problems = [f"{field}: {getattr(record, field)!r} != {getattr(expected, field)!r}"
+                for field in FIELDS if getattr(record, field) != getattr(expected, field)]
+    try:
+        enriched = json.loads(record.raw_with_enrichment(ENRICHMENT), object_pairs_hook=unique_members)
+    except ValueError as e:
+        problems.append(f"enriched event: {e}")
+    else:
+        if enriched != {**event, 'enrichment': ENRICHMENT}:
+            problems.append(f"enriched event differs: {enriched}")
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check stream payload decoding against recorded events")
+    parser.add_argument('fixtures', nargs='*', default=[DEFAULT_FIXTURES], help="JSON lines files of events")
+    args = parser.parse_args()
+
+    failures = checked = 0
+    for path in args.fixtures:
+        with open(path, 'rb') as f:
+            lines = [line.strip() for line in f if line.strip()]
+        records = event_codec.decode_payload(b'{"events":[' + b','.join(lines) + b']}')
+        for line, record in zip(lines, records):
+            checked += 1
+            for problem in check_event(line, record):
+                failures += 1
+                print(f"{path}: event {record.id}: {problem}")
+    decoder = 'msgspec' if event_codec.msgspec is not None else 'stdlib'
+    print(f"{checked} events checked with the {decoder} decoder, {failures} problems")
+    if failures:
+        raise SystemExit("FAIL")
+    print("OK")
@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stream_consumer
+from mra_client import TokenManager
+from mock_mra import start_mock_server, server_url
+
+# Checks that stream_consumer resumes without gaps or duplicates: consume_events runs
+# against the mock stream, which closes every connection after --drop-after messages,
+# and is stopped and restarted from its file checkpoint halfway through, like a viewer
+# being restarted. Every event id must be handled exactly once.
+
+
+class Stop(Exception):
+    pass
+
+
+# Function to consume the stream until `until` events are handled or Stop is raised at
+# the first event after it (so that event is not checkpointed and is resent on resume)
+def consume(mock, checkpoint, seen, until):
+    def handle_event(event):
+        if event.event != 'events':
+            return
+        if len(seen) >= until:
+            raise Stop()
+        seen.extend(e['id'] for e in json.loads(event.data)['events'])
+        if len(seen) >= until and until == mock.max_events:
+            raise Stop()
+
+    base = server_url(mock)
+    token_manager = TokenManager('mock-key', f'{base}/oauth2/token')
+    try:
+        stream_consumer.consume_events(f'{base}/mra/stream/v2/events', token_manager, handle_event, checkpoint)
+    except Stop:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check stream resumption across dropped connections and restarts")
+    parser.add_argument('--events', type=int, default=200)
+    parser.add_argument('--drop-after', type=int, default=20, help="messages per stream connection")
+    args = parser.parse_args()
+
+    # CHECKPOINT_INTERVAL only delays saves between reconnects; save on every message here
+    stream_consumer.CHECKPOINT_INTERVAL = 0
+    mock = start_mock_server(max_events=args.events, drop_after=args.drop_after)
+    seen = []
+    with tempfile.TemporaryDirectory() as workdir:
+        checkpoint = stream_consumer.FileCheckpoint(os.path.join(workdir, 'stream.checkpoint'))
+        consume(mock, checkpoint, seen, args.events // 2)
+        print(f"Stopped after {len(seen)} events at checkpoint {checkpoint.load()}, restarting")
+        consume(mock, checkpoint, seen, args.events)
+
+    counts = Counter(seen)
+    expected = {f'evt-{seq}' for seq in range(args.events)}
+    missing = expected - counts.keys()
+    duplicates = sorted(event_id for event_id, count in counts.items() if count > 1)
+    print(f"{len(seen)} events over {mock.connections} connections, "
+          f"{len(missing)} missing, {len(duplicates)} duplicated")
+    if missing or duplicates:
+        raise SystemExit(f"FAIL: missing {sorted(missing)[:10]}, duplicated {duplicates[:10]}")
+    print("OK")
@@ -0,0 +1,223 @@
+import copy
+import json
+import time
+import argparse
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Local stand-in for the parts of the Mobile Risk API v2 used by this project
+MAX_PAGE_SIZE = 1000
+TOKEN_EXPIRES_IN = 3600
+PLATFORMS = ('ANDROID', 'IOS')
+MODELS = ('Pixel 8', 'iPhone 15', 'Galaxy S23', 'iPad Pro')
+EVENT_TYPES = ('THREAT', 'THREAT', 'DEVICE', 'AUDIT')
+DEFAULT_MIX = 'THREAT=2,DEVICE=1,AUDIT=1'
+
+
+# Function to build the synthetic device with a given oid
+def make_device(oid):
+    return {
+        'oid': oid,
+        'guid': f'00000000-0000-4000-8000-{oid:012d}',
+        'email': f'user{oid}@example.com',
+        'platform': PLATFORMS[oid % len(PLATFORMS)],
+        'activation_status': 'ACTIVATED',
+        'security_status': 'SECURE',
+        'hardware': {'manufacturer': 'Example', 'model': MODELS[oid % len(MODELS)]},
+        'software': {'os_version': '14', 'sdk_version': '1.0.0'},
+    }
+
+
+# Function to parse an event-type mix such as "THREAT=2,DEVICE=1,AUDIT=1"
+# Returns the repeating sequence of event types the stream cycles through.
+def parse_mix(mix):
+    event_types = []
+    for part in mix.split(','):
+        event_type, _, weight = part.strip().partition('=')
+        event_types.extend([event_type.upper()] * int(weight or 1))
+    if not event_types:
+        raise ValueError(f"Empty event-type mix: {mix!r}")
+    return tuple(event_types)
+
+
+# Function to load recorded events (one JSON object per line), grouped by event type
+def load_fixtures(path):
+    fixtures = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                event = json.loads(line)
+                fixtures.setdefault(event['type'], []).append(event)
+    return fixtures
+
+
+# Function to format the current time like the API's created_time (millisecond precision)
+def now_created_time():
+    return datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+
+
+# Function to build the stream event with a given sequence number
+# Events are replayed from fixtures when there is one of the chosen type; the id,
+# created_time and device GUIDs are rewritten so every event is unique and current.
+def make_event(seq, device_count, event_types=EVENT_TYPES, fixtures=None):
+    event_type = event_types[seq % len(event_types)]
+    device_guid = make_device(seq % max(device_count, 1) + 1)['guid']
+    recorded = (fixtures or {}).get(event_type)
+    if recorded:
+        event = copy.deepcopy(recorded[(seq // len(event_types)) % len(recorded)])
+        event['id'] = f'evt-{seq}'
+        event['created_time'] = now_created_time()
+        event.setdefault('actor', {})['guid'] = device_guid
+        if event.get('target', {}).get('type') == 'DEVICE':
+            event['target']['guid'] = device_guid
+        if 'device' in event:
+            event['device']['guid'] = device_guid
+        return event
+    event = {
+        'id': f'evt-{seq}',
+        'type': event_type,
+        'change_type': 'CREATED' if seq % 3 else 'UPDATED',
+        'created_time': now_created_time(),
+        'actor': {'type': 'DEVICE', 'guid': device_guid},
+        'target': {'type': 'DEVICE', 'guid': device_guid},
+    }
+    if event_type == 'THREAT':
+        event['threat'] = {
+            'type': 'APPLICATION',
+            'severity': ('LOW', 'MEDIUM', 'HIGH')[seq % 3],
+            'status': 'OPEN',
+            'classifications': ['TROJAN'],
+            'details': {'application_name': 'Example App', 'package_name': 'com.example.app'},
+        }
+    elif event_type == 'DEVICE':
+        event['device'] = {'guid': device_guid, 'activation_status': 'ACTIVATED'}
+    else:
+        event['audit'] = {'type': 'DEVICE', 'attribute_changes': [{'name': 'email', 'from': 'a', 'to': 'b'}]}
+    return event
+
+
+class MockMRAHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass  # keep benchmark output clean
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if urlparse(self.path).path == '/oauth2/token':
+            self._send_json(200, {'access_token': 'mock-token', 'expires_in': TOKEN_EXPIRES_IN})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/mra/api/v2/devices':
+            self._get_devices(query)
+        elif url.path == '/mra/stream/v2/events':
+            self._stream_events()
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    # Devices are paginated by oid: a page holds the devices with oid greater than the given one
+    def _get_devices(self, query):
+        limit = min(int(query.get('limit', ['100'])[0]), MAX_PAGE_SIZE)
+        after = int(query.get('oid', ['0'])[0])
+        first = after + 1
+        last = min(after + limit, self.server.device_count)
+        devices = [make_device(oid) for oid in range(first, last + 1)]
+        self._send_json(200, {'count': len(devices), 'devices': devices})
+
+    # SSE stream of synthetic events. Honours Last-Event-ID, and closes the connection
+    # after drop_after messages to exercise client reconnects.
+    def _stream_events(self):
+        server = self.server
+        last_id = self.headers.get('Last-Event-ID')
+        seq = int(last_id.rsplit('-', 1)[-1]) + 1 if last_id else 0
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        server.connections += 1
+        sent = 0
+        interval = 1.0 / server.rate if server.rate else 0.0
+        try:
+            self.wfile.write(b'event: heartbeat\ndata: {}\n\n')
+            while server.max_events is None or seq < server.max_events:
+                if server.drop_after and sent >= server.drop_after:
+                    return
+                events = [make_event(seq + i, server.device_count, server.event_types, server.fixtures)
+                          for i in range(server.batch_size)]
+                seq += len(events)
+                message = json.dumps({'events': events})
+                self.wfile.write(f'id: msg-{seq - 1}\nevent: events\ndata: {message}\n\n'.encode('utf-8'))
+                self.wfile.flush()
+                sent += 1
+                if interval:
+                    time.sleep(interval)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+# Function to start the mock API on a background thread, returns the server
+# rate is SSE messages per second (0 = as fast as possible), batch_size events per message,
+# mix the event-type mix (see parse_mix) and fixtures a path to recorded events.
+def start_mock_server(host='127.0.0.1', port=0, device_count=10000, max_events=None,
+                      drop_after=0, rate=0, batch_size=1, mix=DEFAULT_MIX, fixtures=None):
+    server = ThreadingHTTPServer((host, port), MockMRAHandler)
+    server.daemon_threads = True
+    configure_server(server, device_count, max_events, drop_after, rate, batch_size, mix, fixtures)
+    threading.Thread(target=server.serve_forever, name='mock-mra', daemon=True).start()
+    return server
+
+
+# Function to set the mock's data and stream parameters on a server
+def configure_server(server, device_count, max_events=None, drop_after=0, rate=0, batch_size=1,
+                     mix=DEFAULT_MIX, fixtures=None):
+    server.device_count = device_count
+    server.event_types = parse_mix(mix)
+    server.fixtures = load_fixtures(fixtures) if fixtures else None
+    server.max_events = max_events
+    server.drop_after = drop_after
+    server.rate = rate
+    server.batch_size = batch_size
+    server.connections = 0
+
+
+# Function to get the base URL of a running mock server
+def server_url(server):
+    host, port = server.server_address[:2]
+    return f'http://{host}:{port}'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local mock of the Lookout MRA v2 API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--devices', type=int, default=10000, help="number of synthetic devices to serve")
+    parser.add_argument('--max-events', type=int, default=None, help="stop the stream after this many events")
+    parser.add_argument('--drop-after', type=int, default=0, help="close each stream connection after N messages")
+    parser.add_argument('--rate', type=float, default=0, help="SSE messages per second (0 = unthrottled)")
+    parser.add_argument('--batch-size', type=int, default=1, help="events per SSE message")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="event-type mix, e.g. THREAT=2,DEVICE=1,AUDIT=1")
+    parser.add_argument('--fixtures', help="recorded events to replay (JSON lines), e.g. benchmarks/fixtures/events.jsonl")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), MockMRAHandler)
+    configure_server(server, args.devices, args.max_events, args.drop_after, args.rate, args.batch_size,
+                     args.mix, args.fixtures)
+    print(f"Mock MRA API listening on http://{args.host}:{args.port} with {args.devices} devices")
+    server.serve_forever()
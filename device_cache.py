@@ -0,0 +1,120 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# Cache configuration
+DEVICE_CACHE_SIZE = int(os.getenv('DEVICE_CACHE_SIZE', 50000))
+DEVICE_CACHE_TTL = float(os.getenv('DEVICE_CACHE_TTL', 300))  # seconds
+DEVICE_CACHE_NEGATIVE_TTL = float(os.getenv('DEVICE_CACHE_NEGATIVE_TTL', 60))  # seconds
+
+_MISSING = object()
+
+
+# Bounded in-process LRU cache with per-entry TTL in front of the KeyDB device lookup.
+# Misses (loader returned None) are cached too, for negative_ttl seconds.
+# bulk_loader, if given, takes a list of GUIDs and returns a dict of guid -> device.
+class DeviceCache:
+    def __init__(self, loader, max_size=DEVICE_CACHE_SIZE, ttl=DEVICE_CACHE_TTL,
+                 negative_ttl=DEVICE_CACHE_NEGATIVE_TTL, bulk_loader=None):
+        self.loader = loader
+        self.bulk_loader = bulk_loader
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # guid -> (expires_at, device or None)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # Return the cached device for a GUID, loading it on a miss or after expiry
+    def get(self, guid):
+        value = self._lookup(guid)
+        if value is not _MISSING:
+            return value
+        return self._load(guid)
+
+    # Split GUIDs into cached values and GUIDs that still need loading
+    def lookup_many(self, guids):
+        found = {}
+        missing = []
+        for guid in dict.fromkeys(guids):
+            value = self._lookup(guid)
+            if value is _MISSING:
+                missing.append(guid)
+            else:
+                found[guid] = value
+        return found, missing
+
+    # Return a dict of guid -> device, loading every missing GUID in one bulk call
+    def get_many(self, guids):
+        found, missing = self.lookup_many(guids)
+        if missing:
+            if self.bulk_loader is None:
+                loaded = {guid: self.loader(guid) for guid in missing}
+            else:
+                loaded = self.bulk_loader(missing)
+            for guid in missing:
+                value = loaded.get(guid)
+                self.put(guid, value)
+                found[guid] = value
+        return found
+
+    def _lookup(self, guid):
+        with self._lock:
+            entry = self._entries.get(guid)
+            if entry is None:
+                self.misses += 1
+                return _MISSING
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[guid]
+                self.misses += 1
+                return _MISSING
+            self._entries.move_to_end(guid)
+            if value is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return value
+
+    def _load(self, guid):
+        value = self.loader(guid)
+        self.put(guid, value)
+        return value
+
+    # Store a value (None caches a miss) and evict the least recently used entries
+    def put(self, guid, value):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        with self._lock:
+            self._entries[guid] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(guid)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    # Drop a GUID, e.g. when a DEVICE update for it arrives
+    def invalidate(self, guid):
+        with self._lock:
+            if self._entries.pop(guid, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_ratio': (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+            }
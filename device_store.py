@@ -0,0 +1,226 @@
+import os
+import ast
+import json
+import argparse
+import redis
+from dotenv import load_dotenv
+from sqlite_store import SQLiteStore
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the stdlib codec
+    orjson = None
+
+# Fields of an MRA v2 device that the viewers use for enrichment
+DEVICE_FIELDS = ('guid', 'oid', 'email', 'platform')
+HARDWARE_FIELDS = ('manufacturer', 'model')
+
+MIGRATE_BATCH_SIZE = 500
+MGET_CHUNK_SIZE = 1000  # keys per MGET when many devices are read at once
+DEVICE_STORE = os.getenv('DEVICE_STORE', 'keydb')  # "keydb", or the path of a local SQLite device file
+
+
+# Function to open the device store selected by DEVICE_STORE: a KeyDB client, or a
+# SQLiteStore (same API subset) for single-node deployments without KeyDB
+def open_store(host, port, location=DEVICE_STORE):
+    if location == 'keydb':
+        return redis.StrictRedis(host=host, port=port, decode_responses=True)
+    return SQLiteStore(location)
+
+
+# Function to reduce a full device record to the fields needed for enrichment
+def slim_device(device):
+    slim = {field: device[field] for field in DEVICE_FIELDS if device.get(field) is not None}
+    hardware = device.get('hardware') or {}
+    hardware = {field: hardware[field] for field in HARDWARE_FIELDS if hardware.get(field) is not None}
+    if hardware:
+        slim['hardware'] = hardware
+    return slim
+
+
+# Function to encode a device record for storage in KeyDB
+def encode_device(device):
+    slim = slim_device(device)
+    if orjson is not None:
+        return orjson.dumps(slim)
+    return json.dumps(slim, separators=(',', ':')).encode('utf-8')
+
+
+# Function to decode a stored device record (accepts legacy str(dict) values too)
+def decode_device(raw):
+    if raw is None:
+        return None
+    try:
+        if orjson is not None:
+            return orjson.loads(raw)
+        return json.loads(raw)
+    except ValueError:
+        pass
+    if isinstance(raw, bytes):
+        raw = raw.decode('utf-8')
+    if not raw.startswith("{'"):
+        raise ValueError(f"Unrecognised device record: {raw[:40]!r}")
+    # Legacy record written with str(device) before the migration
+    try:
+        return slim_device(ast.literal_eval(raw))
+    except SyntaxError as e:
+        raise ValueError(str(e)) from e
+
+
+# Function to check whether a stored value still uses the legacy str(dict) format
+def is_legacy_record(raw):
+    if isinstance(raw, bytes):
+        return raw.startswith(b"{'")
+    return raw.startswith("{'")
+
+
+# Function to store a device in KeyDB
+def put_device(r, device):
+    r.set(device['guid'], encode_device(device))
+
+
+# Function to store a page of devices in KeyDB with a single MSET round trip
+def put_devices(r, devices):
+    if devices:
+        r.mset({device['guid']: encode_device(device) for device in devices})
+
+
+# Function to read a device from KeyDB, returns None if the GUID is unknown
+def get_device(r, guid):
+    return decode_device(r.get(guid))
+
+
+# Function to remove a device from KeyDB
+def delete_device(r, guid):
+    r.delete(guid)
+
+
+# Function to get the GUID of the device a DEVICE event refers to
+def device_event_guid(event):
+    device = event.get('device') or {}
+    return device.get('guid') or (event.get('target') or {}).get('guid')
+
+
+# Function to merge a DEVICE event onto the cached record for that device
+# Stream events may only carry the changed attributes, so cached fields are kept.
+def merge_device_event(existing, event):
+    device = event.get('device') or {}
+    existing = existing or {}
+    merged = {**existing, **device, 'guid': device_event_guid(event)}
+    merged['hardware'] = {**(existing.get('hardware') or {}), **(device.get('hardware') or {})}
+    return merged
+
+
+# Function to apply a DEVICE event from the MRA v2 stream to the cache
+# Returns (action, guid) where action is 'deleted', 'upserted' or None when the
+# event carries no device GUID.
+def apply_device_event(r, event):
+    guid = device_event_guid(event)
+    if not guid:
+        return None, None
+    if event.get('change_type') == 'DELETED':
+        delete_device(r, guid)
+        return 'deleted', guid
+    try:
+        existing = get_device(r, guid)
+    except ValueError:
+        existing = None
+    put_device(r, merge_device_event(existing, event))
+    return 'upserted', guid
+
+
+# Function to decode the values of an MGET into a dict of guid -> device
+# Unknown GUIDs and undecodable records map to None.
+def decode_devices(guids, raws):
+    devices = {}
+    for guid, raw in zip(guids, raws):
+        try:
+            devices[guid] = decode_device(raw)
+        except ValueError:
+            devices[guid] = None
+    return devices
+
+
+# Function to read several devices with one MGET round trip
+def get_devices(r, guids):
+    guids = list(guids)
+    if not guids:
+        return {}
+    return decode_devices(guids, r.mget(guids))
+
+
+# Function to read many devices with MGETs of chunk_size keys, sent in one pipelined round trip
+def get_devices_pipelined(r, guids, chunk_size=MGET_CHUNK_SIZE):
+    guids = list(guids)
+    if not guids:
+        return {}
+    chunks = [guids[i:i + chunk_size] for i in range(0, len(guids), chunk_size)]
+    pipe = r.pipeline(transaction=False)
+    for chunk in chunks:
+        pipe.mget(chunk)
+    devices = {}
+    for chunk, raws in zip(chunks, pipe.execute()):
+        devices.update(decode_devices(chunk, raws))
+    return devices
+
+
+# Function to extract the enrichment fields stored alongside an archived event
+def enrichment_fields(device):
+    device = device or {}
+    return {
+        'email': device.get('email'),
+        'device_model': (device.get('hardware') or {}).get('model'),
+        'platform': device.get('platform'),
+    }
+
+
+# Function to rewrite every legacy device record in KeyDB with the compact encoding
+def migrate(r, batch_size=MIGRATE_BATCH_SIZE):
+    migrated = skipped = 0
+    keys = []
+    for key in r.scan_iter(count=batch_size, _type='string'):
+        keys.append(key)
+        if len(keys) >= batch_size:
+            m, s = _migrate_keys(r, keys)
+            migrated, skipped = migrated + m, skipped + s
+            keys = []
+    if keys:
+        m, s = _migrate_keys(r, keys)
+        migrated, skipped = migrated + m, skipped + s
+    return migrated, skipped
+
+
+def _migrate_keys(r, keys):
+    migrated = skipped = 0
+    pipe = r.pipeline(transaction=False)
+    for key, raw in zip(keys, r.mget(keys)):
+        if raw is None or not is_legacy_record(raw):
+            skipped += 1
+            continue
+        try:
+            device = ast.literal_eval(raw if isinstance(raw, str) else raw.decode('utf-8'))
+        except (ValueError, SyntaxError):
+            skipped += 1
+            continue
+        if not isinstance(device, dict) or 'guid' not in device:
+            skipped += 1
+            continue
+        pipe.set(key, encode_device(device))
+        migrated += 1
+    pipe.execute()
+    return migrated, skipped
+
+
+if __name__ == "__main__":
+    load_dotenv('production.env')
+    parser = argparse.ArgumentParser(description="Device store maintenance for the KeyDB device cache")
+    parser.add_argument('command', choices=['migrate'], help="migrate: rewrite legacy str(dict) records in the compact encoding")
+    args = parser.parse_args()
+
+    KEYDB_HOST = os.getenv('KEYDB_HOST', 'localhost')
+    KEYDB_PORT = int(os.getenv('KEYDB_PORT', 6379))
+    r = redis.StrictRedis(host=KEYDB_HOST, port=KEYDB_PORT, decode_responses=True)
+
+    if args.command == 'migrate':
+        migrated, skipped = migrate(r)
+        print(f"Migrated {migrated} device records ({skipped} keys skipped).")
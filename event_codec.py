@@ -0,0 +1,173 @@
+import json
+from collections import namedtuple
+
+# Optional fast JSON libraries: msgspec allows decoding only the routing fields of
+# each event and keeping its original bytes, orjson is a faster drop-in for json.
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+Threat = namedtuple('Threat', ['type', 'severity', 'status', 'classifications', 'details'])
+Audit = namedtuple('Audit', ['type', 'attribute_changes'])
+
+
+class DecodeError(ValueError):
+    pass
+
+
+# Function to decode JSON with the fastest available library
+if orjson is not None:
+    def loads(data):
+        return orjson.loads(data)
+elif msgspec is not None:
+    _json_decoder = msgspec.json.Decoder()
+
+    def loads(data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return _json_decoder.decode(data)
+else:
+    def loads(data):
+        return json.loads(data)
+
+
+# Function to encode compact JSON as bytes with the fastest available library
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj)
+elif msgspec is not None:
+    _json_encoder = msgspec.json.Encoder()
+
+    def dumps(obj):
+        return _json_encoder.encode(obj)
+else:
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+# One event of a stream payload. The routing fields are always decoded; the full
+# event dict and its JSON bytes are produced lazily, only if something needs them.
+class EventRecord:
+    __slots__ = ('type', 'change_type', 'created_time', 'actor_guid', 'actor_type',
+                 'target_guid', 'target_type', 'id', '_raw', '_event')
+
+    def __init__(self, type, change_type, created_time, actor_guid, actor_type,
+                 target_guid, target_type, raw=None, event=None, id=None):
+        self.id = id
+        self.type = type or 'UNKNOWN'
+        self.change_type = change_type or 'UNKNOWN'
+        self.created_time = created_time
+        self.actor_guid = actor_guid
+        self.actor_type = actor_type
+        self.target_guid = target_guid
+        self.target_type = target_type
+        self._raw = raw
+        self._event = event
+
+    # raw is the event's original JSON bytes, when known
+    @classmethod
+    def from_event(cls, event, raw=None):
+        if not isinstance(event, dict):
+            raise DecodeError("Stream event is not a JSON object")
+        actor = event.get('actor') if isinstance(event.get('actor'), dict) else {}
+        target = event.get('target') if isinstance(event.get('target'), dict) else {}
+        return cls(event.get('type'), event.get('change_type'), event.get('created_time'),
+                   actor.get('guid'), actor.get('type'), target.get('guid'), target.get('type'),
+                   raw=raw, event=event, id=event.get('id'))
+
+    # Original JSON bytes of the event (re-encoded only when the payload was fully decoded)
+    @property
+    def raw(self):
+        if self._raw is None:
+            self._raw = dumps(self._event)
+        return self._raw
+
+    # Full event as a dict
+    @property
+    def event(self):
+        if self._event is None:
+            self._event = loads(self._raw)
+        return self._event
+
+    def threat(self):
+        threat = self.event.get('threat') or {}
+        return Threat(threat.get('type', 'N/A'), threat.get('severity', 'N/A'), threat.get('status', 'N/A'),
+                      threat.get('classifications', []), threat.get('details', {}))
+
+    def audit(self):
+        audit = self.event.get('audit') or {}
+        return Audit(audit.get('type', 'N/A'), audit.get('attribute_changes', []))
+
+    def device(self):
+        return self.event.get('device') or {}
+
+    # JSON bytes of the event with an extra "enrichment" member, without re-encoding the event
+    # unless it already has one (which is then replaced)
+    def raw_with_enrichment(self, enrichment):
+        if b'"enrichment"' in self.raw and 'enrichment' in self.event:
+            return dumps({**self.event, 'enrichment': enrichment})
+        body = self.raw.rstrip()
+        extra = b'"enrichment":' + dumps(enrichment) + b'}'
+        if body[:-1].rstrip().endswith(b'{'):
+            return body[:-1] + extra
+        return body[:-1] + b',' + extra
+
+
+if msgspec is not None:
+    class _Ref(msgspec.Struct):
+        guid: 'str | None' = None
+        type: 'str | None' = None
+
+    class _Header(msgspec.Struct):
+        id: 'str | int | None' = None
+        type: 'str | None' = None
+        change_type: 'str | None' = None
+        created_time: 'str | None' = None
+        actor: '_Ref | None' = None
+        target: '_Ref | None' = None
+
+    class _Payload(msgspec.Struct):
+        events: 'list[msgspec.Raw]' = []
+
+    _payload_decoder = msgspec.json.Decoder(_Payload)
+    _header_decoder = msgspec.json.Decoder(_Header)
+
+    # Function to decode a stream payload into EventRecords, parsing only the routing fields
+    def decode_payload(data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        try:
+            records = []
+            for raw in _payload_decoder.decode(data).events:
+                raw = bytes(raw)
+                try:
+                    header = _header_decoder.decode(raw)
+                except msgspec.ValidationError:
+                    # A routing field of another type (e.g. a numeric created_time): decode
+                    # this event fully instead, as the stdlib path does
+                    records.append(EventRecord.from_event(loads(raw), raw=raw))
+                    continue
+                actor = header.actor or _Ref()
+                target = header.target or _Ref()
+                records.append(EventRecord(header.type, header.change_type, header.created_time,
+                                           actor.guid, actor.type, target.guid, target.type, raw=raw,
+                                           id=header.id))
+            return records
+        except msgspec.DecodeError as e:
+            raise DecodeError(str(e)) from e
+else:
+    # Function to decode a stream payload into EventRecords
+    def decode_payload(data):
+        try:
+            payload = loads(data)
+        except ValueError as e:
+            raise DecodeError(str(e)) from e
+        if not isinstance(payload, dict):
+            raise DecodeError("Stream payload is not a JSON object")
+        return [EventRecord.from_event(event) for event in payload.get('events', [])]
@@ -0,0 +1,206 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import event_codec
+
+logger = logging.getLogger(__name__)
+
+# De-duplication configuration
+DEDUPE_WINDOW = float(os.getenv('DEDUPE_WINDOW', 300))  # seconds an event id/content hash is remembered, 0 disables
+DEDUPE_MAX_ENTRIES = int(os.getenv('DEDUPE_MAX_ENTRIES', 200000))
+# Types whose events are also matched by content, to catch re-emitted entity states with a new id
+DEDUPE_CONTENT_TYPES = frozenset(t.strip() for t in os.getenv('DEDUPE_CONTENT_TYPES', 'THREAT,DEVICE').split(',') if t.strip())
+VOLATILE_FIELDS = frozenset(('id', 'created_time'))  # ignored by the content hash
+
+# Coalescing configuration (disabled unless COALESCE_WINDOW is set)
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', 0))  # seconds an entity's changes are held
+COALESCE_TYPES = frozenset(t.strip() for t in os.getenv('COALESCE_TYPES', 'THREAT,DEVICE').split(',') if t.strip())
+COALESCE_MAX_HELD = int(os.getenv('COALESCE_MAX_HELD', 10000))
+COALESCE_CHECK_INTERVAL = 0.5  # seconds between window checks
+
+
+# Function to hash the content of an event, ignoring its id and created_time
+# This decodes the full event, which is why it is limited to DEDUPE_CONTENT_TYPES.
+def content_hash(record):
+    content = {key: value for key, value in record.event.items() if key not in VOLATILE_FIELDS}
+    return hashlib.blake2b(event_codec.dumps(content), digest_size=16).digest()
+
+
+# Remembers the ids of recent events for window seconds (at most max_entries of them,
+# oldest dropped first) to recognise events that were already seen, e.g. events replayed
+# after a reconnect. For content_types it also remembers the content hash of each entity's
+# latest event (keyed like coalesce_key), so the same state emitted again under a new id
+# is dropped, while a return to an earlier state (a reopened THREAT) is not.
+class Deduplicator:
+    def __init__(self, window=DEDUPE_WINDOW, max_entries=DEDUPE_MAX_ENTRIES, content_types=DEDUPE_CONTENT_TYPES):
+        self.window = window
+        self.max_entries = max_entries
+        self.content_types = content_types
+        self._seen = OrderedDict()  # key -> (expires_at, content hash of an entity key), oldest first
+        self._lock = threading.Lock()
+        self.duplicates = 0
+        self.evictions = 0
+
+    # Keys of an event: ('id', id) and, for content types, (('entity', entity), content hash)
+    # Events without an id fall back to their content hash as id.
+    def _keys(self, record):
+        id_key = ('id', record.id) if record.id is not None else None
+        entity_key = digest = None
+        if record.type in self.content_types or id_key is None:
+            digest = content_hash(record)
+            entity = coalesce_key(record, self.content_types)
+            if entity is not None:
+                entity_key = ('entity', entity)
+            elif id_key is None:
+                id_key = ('content', digest)
+        return id_key, entity_key, digest
+
+    def _expire(self, now):
+        while self._seen:
+            key, (expires_at, _) = next(iter(self._seen.items()))
+            if expires_at > now:
+                break
+            del self._seen[key]
+
+    def _remember(self, key, expires_at, value=None):
+        self._seen[key] = (expires_at, value)
+        self._seen.move_to_end(key)
+
+    # Return True if the event was seen within the window, and remember it either way
+    def seen(self, record):
+        if self.window <= 0:
+            return False
+        id_key, entity_key, digest = self._keys(record)
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            duplicate = id_key is not None and id_key in self._seen
+            if entity_key is not None and not duplicate:
+                latest = self._seen.get(entity_key)
+                duplicate = latest is not None and latest[1] == digest
+            if id_key is not None:
+                self._remember(id_key, now + self.window)
+            if entity_key is not None:
+                # A replayed older event must not replace the entity's latest state
+                if not duplicate or self._seen.get(entity_key, (0, None))[1] == digest:
+                    self._remember(entity_key, now + self.window, digest)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+                self.evictions += 1
+            if duplicate:
+                self.duplicates += 1
+            return duplicate
+
+    # Forget an event, so it is processed again if it comes back (e.g. after a failure)
+    def forget(self, record):
+        if self.window <= 0:
+            return
+        id_key, entity_key, digest = self._keys(record)
+        with self._lock:
+            if id_key is not None:
+                self._seen.pop(id_key, None)
+            if entity_key is not None and self._seen.get(entity_key, (0, None))[1] == digest:
+                del self._seen[entity_key]
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._seen), 'duplicates': self.duplicates, 'evictions': self.evictions}
+
+
+# Function to get the entity an event describes, for coalescing (None if it is not coalesced)
+# THREAT events are keyed by threat GUID, DEVICE events by the device GUID.
+def coalesce_key(record, types=COALESCE_TYPES):
+    if record.type not in types:
+        return None
+    if record.type == 'THREAT':
+        threat = record.event.get('threat') or {}
+        guid = threat.get('guid') or record.target_guid
+    else:
+        guid = record.target_guid
+    return (record.type, guid) if guid else None
+
+
+# Holds the latest change of each entity for up to window seconds before emitting it;
+# a newer change of the same entity within the window replaces the held one, so rapid
+# successive changes result in a single write. emit(*args, on_stored=...) is called for
+# every survivor; the on_stored of a replaced change is called when it is replaced, as that
+# change no longer needs to be written.
+class Coalescer:
+    def __init__(self, emit, window=COALESCE_WINDOW, max_held=COALESCE_MAX_HELD):
+        self.emit = emit
+        self.window = window
+        self.max_held = max_held
+        self._held = OrderedDict()  # key -> [deadline, args, on_stored], oldest deadline first
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._timer = None
+        self.coalesced = 0
+
+    # Hold args under key; returns False if coalescing is disabled (caller emits directly)
+    def add(self, key, *args, on_stored=None):
+        if self.window <= 0 or key is None:
+            return False
+        ready = []
+        replaced = None
+        with self._lock:
+            held = self._held.get(key)
+            if held is not None:
+                # Keep the first deadline, so a busy entity is still written every window
+                replaced = held[2]
+                held[1], held[2] = args, on_stored
+                self.coalesced += 1
+            else:
+                self._held[key] = [time.monotonic() + self.window, args, on_stored]
+                while len(self._held) > self.max_held:
+                    ready.append(self._held.popitem(last=False)[1])
+        if replaced is not None:
+            replaced()
+        self._emit(ready)
+        return True
+
+    def _emit(self, ready):
+        for _, args, on_stored in ready:
+            self.emit(*args, on_stored=on_stored)
+
+    # Emit the changes whose window has passed
+    def flush_expired(self):
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            while self._held:
+                key, held = next(iter(self._held.items()))
+                if held[0] > now:
+                    break
+                del self._held[key]
+                ready.append(held)
+        self._emit(ready)
+
+    # Emit everything that is held
+    def flush_all(self):
+        with self._lock:
+            ready = list(self._held.values())
+            self._held.clear()
+        self._emit(ready)
+
+    def start(self):
+        if self.window > 0 and self._timer is None:
+            self._timer = threading.Thread(target=self._run, name='coalescer', daemon=True)
+            self._timer.start()
+
+    def _run(self):
+        while not self._stop.wait(COALESCE_CHECK_INTERVAL):
+            self.flush_expired()
+
+    def close(self):
+        self._stop.set()
+        if self._timer is not None:
+            self._timer.join()
+            self._timer = None
+        self.flush_all()
@@ -0,0 +1,178 @@
+import os
+import json
+import logging
+import operator
+import threading
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Rules configuration
+EVENT_RULES_FILE = os.getenv('EVENT_RULES_FILE')  # JSON rules file, unset keeps every event
+DEFAULT_EVENT_TYPES = 'THREAT,DEVICE,AUDIT'
+
+DROP = 'drop'
+KEEP = 'keep'
+
+# Fields available on every EventRecord without decoding the full event
+HEADER_FIELDS = {
+    'type': 'type',
+    'change_type': 'change_type',
+    'created_time': 'created_time',
+    'actor.guid': 'actor_guid',
+    'actor.type': 'actor_type',
+    'target.guid': 'target_guid',
+    'target.type': 'target_type',
+}
+
+# What happens to an event: dropped, or kept and (optionally) enriched, archived under an
+# extra S3 prefix and/or appended to a local NDJSON sink
+Route = namedtuple('Route', ['name', 'action', 'enrich', 'archive', 'prefix', 'sink'])
+
+
+# Function to build a getter for a dotted field path ("threat.severity")
+# Header fields are read from the EventRecord; anything else decodes the full event.
+def field_getter(path):
+    if path in HEADER_FIELDS:
+        return operator.attrgetter(HEADER_FIELDS[path])
+    keys = path.split('.')
+
+    def get(record):
+        value = record.event
+        for key in keys:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+    return get
+
+
+# Function to compile one "match" object into a list of (getter, allowed values, negated, path)
+# A key starting with "!" matches when the field has none of the listed values.
+def compile_conditions(match):
+    conditions = []
+    for path, values in match.items():
+        negated = path.startswith('!')
+        path = path.lstrip('!')
+        if not isinstance(values, list):
+            values = [values]
+        if any(isinstance(value, (dict, list)) for value in values):
+            raise ValueError(f"Condition on {path!r}: values must be strings, numbers, booleans or null")
+        conditions.append((field_getter(path), frozenset(values), negated, path))
+    # Header fields are cheap: test them first so most events never need a full decode
+    conditions.sort(key=lambda condition: condition[3] not in HEADER_FIELDS)
+    return conditions
+
+
+# Function to test a field value against a condition's allowed values
+# A list matches if any of its items does; objects (dicts) never match.
+def _matches(value, allowed):
+    if isinstance(value, list):
+        return any(item in allowed for item in value if not isinstance(item, (dict, list)))
+    if isinstance(value, dict):
+        return False
+    return value in allowed
+
+
+# Function to build the Route of a rule (or of the default)
+# A dropped event is never enriched, archived or written to a sink, whatever the rule says.
+def make_route(name, spec):
+    action = spec.get('action', KEEP)
+    if action not in (DROP, KEEP):
+        raise ValueError(f"Rule {name}: unknown action {action!r} (expected {DROP!r} or {KEEP!r})")
+    if action == DROP:
+        return Route(name, action, False, False, '', None)
+    prefix = spec.get('prefix', '')
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    return Route(name, action, spec.get('enrich', True), spec.get('archive', True), prefix, spec.get('sink'))
+
+
+# Appends events to a local NDJSON file. The file is opened on the first write, and every
+# line is one unbuffered append, so several worker processes can share a sink.
+class FileSink:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def write(self, raw):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'ab', buffering=0)
+            self._file.write(raw + b'\n')
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# Precompiled rules: the first rule whose conditions all match decides the event's Route,
+# events matching no rule get the default route.
+# types are the event types to stream unless the configuration has its own "types".
+class RuleSet:
+    def __init__(self, config=None, types=DEFAULT_EVENT_TYPES):
+        config = config or {}
+        self.types = config.get('types', types)
+        self.default = make_route('default', config.get('default', {}))
+        self._rules = []
+        for index, rule in enumerate(config.get('rules', [])):
+            name = rule.get('name', f'rule-{index + 1}')
+            self._rules.append((compile_conditions(rule.get('match', {})), make_route(name, rule)))
+        if not self.server_types():
+            raise ValueError(f"The rules drop every event type to stream ({self.types}), nothing would be processed")
+        self._sinks = {}
+        for _, route in self._rules + [((), self.default)]:
+            if route.sink and route.sink not in self._sinks:
+                self._sinks[route.sink] = FileSink(route.sink)
+
+    # Decide what happens to one EventRecord
+    def route(self, record):
+        for conditions, route in self._rules:
+            for get, allowed, negated, _ in conditions:
+                found = _matches(get(record), allowed)
+                if found == negated:
+                    break
+            else:
+                return route
+        return self.default
+
+    # Event types to request from the server: the configured types, minus the types that a
+    # rule matching on "type" alone drops before any other rule could keep them
+    def server_types(self):
+        types = [t.strip() for t in self.types.split(',') if t.strip()]
+        claimed = set()  # types an earlier rule may match
+        for conditions, route in self._rules:
+            type_condition = next((c for c in conditions if c[3] == 'type'), None)
+            if type_condition is None:
+                break  # this rule may match any type
+            _, allowed, negated, _ = type_condition
+            unconditional_drop = len(conditions) == 1 and route.action == DROP
+            if negated:
+                if unconditional_drop:
+                    types = [t for t in types if t in allowed or t in claimed]
+                break
+            if unconditional_drop:
+                types = [t for t in types if t not in allowed or t in claimed]
+            claimed |= allowed
+        return ','.join(types)
+
+    def sink(self, route):
+        return self._sinks[route.sink]
+
+    def close(self):
+        for sink in self._sinks.values():
+            sink.close()
+
+
+# Function to load a RuleSet from a JSON file (path None keeps every event)
+def load_rules(path=EVENT_RULES_FILE, types=DEFAULT_EVENT_TYPES):
+    if not path:
+        return RuleSet(types=types)
+    with open(path) as f:
+        config = json.load(f)
+    rules = RuleSet(config, types)
+    logger.info(f"Loaded {len(config.get('rules', []))} event rules from {path}")
+    return rules
@@ -1,27 +1,40 @@
 #!/usr/bin/python3
 import os
 import json
-import ast
+import time
+import signal
+import threading
+import argparse
 import redis
-import requests
-import boto3
+import sqlite3
 import logging
-from logging.handlers import RotatingFileHandler
 from dotenv import load_dotenv
-from sseclient import SSEClient
 from colorama import Fore, init
+import device_store
+import event_codec
+import event_rules
+import event_dedupe
+import log_setup
+import metrics
+from device_cache import DeviceCache
+from mra_client import TokenManager, make_token_cache
+from stream_consumer import consume_events, make_checkpoint, PendingMessages
+from s3_archiver import S3BatchArchiver
+from upload_pool import UploadPool, make_s3_client
+from spool import Spool
+from shard_pool import ShardPool, CONTEXT as SHARD_CONTEXT
 
 # Load environment variables and initialize colorama
 load_dotenv('production.env')
 init(autoreset=True)
 
-# Initialize Redis (KeyDB) connection
+# Initialize Redis (KeyDB) connection, or the local device file selected by DEVICE_STORE
 KEYDB_HOST = os.getenv('KEYDB_HOST', 'localhost')
 KEYDB_PORT = int(os.getenv('KEYDB_PORT', 6379))
-r = redis.StrictRedis(host=KEYDB_HOST, port=KEYDB_PORT, decode_responses=True)
+r = device_store.open_store(KEYDB_HOST, KEYDB_PORT)
 
 # Constants
-LOOKOUT_API_URL = 'https://api.lookout.com'
+LOOKOUT_API_URL = os.getenv('LOOKOUT_API_URL', 'https://api.lookout.com')
 TOKEN_URL = f'{LOOKOUT_API_URL}/oauth2/token'
 EVENTS_STREAM_URL = f'{LOOKOUT_API_URL}/mra/stream/v2/events'
 
@@ -34,114 +47,388 @@ LOG_FILE = 'improvedviewer.log'
 MAX_LOG_SIZE = 5 * 1024 * 1024  # 5 MB
 BACKUP_COUNT = 3
 
-# Initialize logging
+# Logging is routed through a queue to the log file, see log_setup.setup_logging
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = RotatingFileHandler(LOG_FILE, maxBytes=MAX_LOG_SIZE, backupCount=BACKUP_COUNT)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-
-# Initialize S3 client
-s3_client = boto3.client('s3', region_name=S3_REGION)
-
-# Authentication function
-def get_access_token(application_key):
-    headers = {
-        'Authorization': f'Bearer {application_key}',
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    data = {
-        'grant_type': 'client_credentials'
-    }
-    response = requests.post(TOKEN_URL, headers=headers, data=data)
-    response.raise_for_status()  # Raise error for bad status
-    token_info = response.json()
-    return token_info['access_token'], token_info['expires_in']
+
+# Headless (service) mode: no console output, one structured JSON log line per event
+HEADLESS = False
+
+# Optional local spool (write-ahead log) of received payloads, enabled with --spool
+# When set, the stream reader only appends to the spool and a processor thread drains it.
+spool = None
+SPOOL_COMMIT_INTERVAL = float(os.getenv('SPOOL_COMMIT_INTERVAL', 30))  # seconds
+SPOOL_RETRY_CAP = 60.0  # seconds
+
+# Optional pool of worker processes (--workers N); the stream reader then only decodes the
+# event headers and hands every event to the worker owning its device
+shard_workers = None
+
+# Stream messages whose events are not all in S3 yet; the checkpoint stays behind them
+# (without --spool, in the process that archives the events)
+pending = None
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', 1))
+
+# Pipeline metrics, served on /metrics with --metrics-port (or METRICS_PORT)
+EVENTS_PROCESSED = metrics.Counter('events_processed_total', 'Stream events processed, by event type', ['type'])
+PAYLOAD_SECONDS = metrics.Histogram('payload_processing_seconds', 'Time to enrich, render and queue one stream payload')
+KEYDB_SECONDS = metrics.Histogram('keydb_request_seconds', 'Latency of KeyDB device lookups, by operation', ['op'])
+ENRICHMENTS = metrics.Counter('enrichments_total', 'Events enriched with device details, by result', ['result'])
+RULE_MATCHES = metrics.Counter('rule_matches_total', 'Events routed by each rule, by rule and action', ['rule', 'action'])
+DUPLICATES = metrics.Counter('events_duplicate_total', 'Events dropped as already seen, by event type', ['type'])
+
+# Filtering and routing rules (--rules or EVENT_RULES_FILE), evaluated before enrichment
+rules = event_rules.RuleSet()
+
+# Initialize S3 client, background upload pool and batched archiver
+s3_client = make_s3_client(S3_REGION)
+upload_pool = UploadPool(s3_client, S3_BUCKET_NAME)
+archiver = S3BatchArchiver(upload_pool)
+
+# Events already seen (same id, or same content as their entity's latest event) within
+# DEDUPE_WINDOW are dropped, and with COALESCE_WINDOW set only the latest of rapid
+# successive changes to a THREAT or DEVICE is archived
+deduplicator = event_dedupe.Deduplicator()
+coalescer = event_dedupe.Coalescer(archiver.add_raw)
+
+# Function to print to the console unless running headless
+def console(message):
+    if not HEADLESS:
+        print(message)
+
+# Function to handle a single SSE event from the stream
+def handle_sse_event(event):
+    if event.event == 'heartbeat':
+        return  # Ignore heartbeat events
+    elif event.event == 'events':
+        if spool is not None:
+            spool.append(event.data.encode('utf-8'))
+            return
+        if shard_workers is not None:
+            dispatch_to_shards(event)
+            return
+        ticket = pending.begin(event.id) if pending is not None else None
+        try:
+            records = event_codec.decode_payload(event.data)
+        except event_codec.DecodeError as e:
+            logger.error(f"Error decoding JSON: {str(e)}")
+            console(f"{Fore.RED}Error decoding JSON: {str(e)}")
+        else:
+            process_event(records, ticket)
+        if ticket is not None:
+            ticket.done()
+    else:
+        logger.warning(f"Unknown event received: {event}", extra={'rate_key': 'unknown_event'})
+        console(f"{Fore.YELLOW}Unknown event received: {event}")
 
 # Function to stream and process events with specific types
-def stream_and_process_events(access_token, event_types="THREAT,DEVICE,AUDIT"):
-    headers = {'Authorization': f'Bearer {access_token}', 'Accept': 'text/event-stream'}
+# Reconnects automatically, refreshes the token before expiry and resumes from the
+# last checkpointed event id
+def stream_and_process_events(token_manager, event_types=event_rules.DEFAULT_EVENT_TYPES):
     params = {'types': event_types}  # Filter by specified event types
-    response = requests.get(EVENTS_STREAM_URL, headers=headers, params=params, stream=True)
-    response.raise_for_status()
-    client = SSEClient(response)
-    
-    for event in client.events():
-        if event.event == 'heartbeat':
-            continue  # Ignore heartbeat events
-        elif event.event == 'events':
-            try:
-                event_data = json.loads(event.data)
-                process_event(event_data)
-            except json.JSONDecodeError as e:
-                logger.error(f"Error decoding JSON: {str(e)}")
-                print(f"{Fore.RED}Error decoding JSON: {str(e)}")
-        else:
-            logger.warning(f"Unknown event received: {event}")
-            print(f"{Fore.YELLOW}Unknown event received: {event}")
+    if shard_workers:
+        acknowledged = shard_workers.acknowledged
+    else:
+        acknowledged = pending.acknowledged if pending is not None else None
+    consume_events(EVENTS_STREAM_URL, token_manager, handle_sse_event,
+                   checkpoint=make_checkpoint(r), params=params, acknowledged=acknowledged)
+
+# Function to turn SIGTERM into a normal shutdown so queued uploads are drained
+def handle_sigterm(signum, frame):
+    logger.info("Received SIGTERM, draining upload queue")
+    raise SystemExit(0)
 
 # Function to get user details from Redis
 def get_user_details_from_redis(guid):
-    user_data = r.get(guid)
+    try:
+        with KEYDB_SECONDS.time(op='get'):
+            user_data = device_store.get_device(r, guid)
+    except ValueError as e:
+        logger.error(f"Error evaluating data for GUID {guid}: {str(e)}")
+        console(f"{Fore.RED}Error evaluating data for GUID {guid}: {str(e)}")
+        return None
     if user_data:
-        try:
-            return ast.literal_eval(user_data)
-        except (ValueError, SyntaxError) as e:
-            logger.error(f"Error evaluating data for GUID {guid}: {str(e)}")
-            print(f"{Fore.RED}Error evaluating data for GUID {guid}: {str(e)}")
-            return None
-    logger.warning(f"No user data found in Redis for GUID: {guid}")
-    print(f"{Fore.RED}No user data found in Redis for GUID: {guid}")
+        return user_data
+    logger.warning(f"No user data found in Redis for GUID: {guid}", extra={'rate_key': 'no_user_data'})
+    console(f"{Fore.RED}No user data found in Redis for GUID: {guid}")
     return None
 
-# Function to upload data to S3
-def upload_to_s3(data, object_key):
+# Function to get user details for several GUIDs from Redis in one round trip
+def get_users_details_from_redis(guids):
+    with KEYDB_SECONDS.time(op='mget'):
+        users = device_store.get_devices(r, guids)
+    for guid in [g for g, user in users.items() if not user]:
+        logger.warning(f"No user data found in Redis for GUID: {guid}", extra={'rate_key': 'no_user_data'})
+        console(f"{Fore.RED}No user data found in Redis for GUID: {guid}")
+    return users
+
+# Function to collect the device GUIDs referenced by a payload (actors, and DEVICE targets)
+def collect_device_guids(records):
+    guids = []
+    for record in records:
+        if record.actor_guid:
+            guids.append(record.actor_guid)
+        if record.target_type == 'DEVICE' and record.target_guid:
+            guids.append(record.target_guid)
+    return guids
+
+# In-process cache in front of KeyDB; misses are cached too so repeated unknown GUIDs
+# don't cost a round trip and a warning on every event
+device_cache = DeviceCache(get_user_details_from_redis, bulk_loader=get_users_details_from_redis)
+
+metrics.Gauge('device_cache_hit_ratio', 'Device cache hit ratio since start', lambda: device_cache.stats()['hit_ratio'])
+metrics.Gauge('device_cache_size', 'Devices held in the in-process cache', lambda: device_cache.stats()['size'])
+metrics.Gauge('s3_upload_queue_depth', 'Batches waiting in the S3 upload queue', lambda: upload_pool.metrics()['queue_depth'])
+metrics.Gauge('events_coalesced', 'Archive writes replaced by a newer change of the same entity',
+              lambda: coalescer.coalesced)
+metrics.Gauge('spool_lag_bytes', 'Spooled bytes not yet committed', lambda: spool.stats()['lag_bytes'] if spool else 0)
+
+# Function to render one event to the console (and the text log)
+def render_event(record, user_details):
+    event_type = record.type
+    change_type = record.change_type
+    created_time = record.created_time or 'N/A'
+    logger.info(f"Processing event - Type: {event_type}, Change Type: {change_type}, Created Time: {created_time}")
+    print(f"{Fore.CYAN}Event Type: {event_type}, Change Type: {change_type}, Created Time: {created_time}")
+    
+    # Process THREAT type events
+    if event_type == 'THREAT':
+        threat = record.threat()
+        logger.info(f"Threat details - Type: {threat.type}, Severity: {threat.severity}, Status: {threat.status}")
+        print(f"  Threat Type: {threat.type}")
+        print(f"  Severity: {threat.severity}")
+        print(f"  Status: {threat.status}")
+        print(f"  Classifications: {json.dumps(threat.classifications, indent=2)}")
+        print(f"  Details: {json.dumps(threat.details, indent=2)}")
+    
+    if user_details:
+        logger.info(f"User details - Email: {user_details.get('email', 'N/A')}, Device Model: {user_details.get('hardware', {}).get('model', 'N/A')}")
+        print(f"{Fore.GREEN}User Email: {user_details.get('email', 'N/A')}")
+        print(f"Device Model: {user_details.get('hardware', {}).get('model', 'N/A')}")
+    
+    print(f"  Actor GUID: {record.actor_guid or 'N/A'}")
+    print(f"  Target GUID: {record.target_guid or 'N/A'}")
+    print("\n" + "-"*60 + "\n")
+
+# Function to log one event as a single structured line (headless mode)
+def log_event(record, enrichment):
+    logger.info("event", extra={
+        'event_type': record.type,
+        'change_type': record.change_type,
+        'created_time': record.created_time,
+        'actor_guid': record.actor_guid,
+        'target_guid': record.target_guid,
+        **enrichment,
+    })
+
+# Function to process each event of a decoded payload
+# Rules and de-duplication are applied first, so dropped, duplicate (and unenriched)
+# events never cost a KeyDB lookup. ticket (a MessageTicket) tracks the archived events
+# until they are in S3.
+def process_event(records, ticket=None):
+    with PAYLOAD_SECONDS.time():
+        selected = []
+        for record in records:
+            route = rules.route(record)
+            RULE_MATCHES.inc(rule=route.name, action=route.action)
+            if route.action == event_rules.DROP:
+                continue
+            if deduplicator.seen(record):
+                DUPLICATES.inc(type=record.type)
+                continue
+            selected.append((record, route))
+        done = 0
+        try:
+            # Resolve every device referenced by the payload with a single MGET up front
+            device_cache.get_many(collect_device_guids([record for record, route in selected if route.enrich]))
+            for record, route in selected:
+                process_record(record, route, ticket)
+                done += 1
+        except Exception:
+            # Events that were not processed must not count as seen when they are retried
+            for record, _ in selected[done:]:
+                deduplicator.forget(record)
+            raise
+
+
+# Function to process one event that passed the rules and de-duplication
+def process_record(record, route, ticket=None):
+    # Keep the KeyDB device cache in sync with DEVICE events
+    if record.type == 'DEVICE':
+        result, device_guid = device_store.apply_device_event(r, record.event)
+        if result:
+            device_cache.invalidate(device_guid)
+            logger.info(f"Device cache {result} for GUID: {device_guid}")
+    
+    # Lookup user details using actor GUID
+    user_details = device_cache.get(record.actor_guid) if record.actor_guid and route.enrich else None
+    enrichment = device_store.enrichment_fields(user_details)
+    EVENTS_PROCESSED.inc(type=record.type)
+    if route.enrich:
+        ENRICHMENTS.inc(result='hit' if user_details else 'miss')
+    if HEADLESS:
+        log_event(record, enrichment)
+    else:
+        render_event(record, user_details)
+
+    # Queue the original event bytes, with the actor's enrichment fields, for batched archival to S3
+    if route.archive or route.sink:
+        line = record.raw_with_enrichment(enrichment)
+        if route.archive:
+            args = (record.type, record.created_time, line, route.prefix)
+            on_stored = ticket.hold() if ticket is not None else None
+            key = event_dedupe.coalesce_key(record) if coalescer.window > 0 else None
+            if not coalescer.add(key, *args, on_stored=on_stored):
+                archiver.add_raw(*args, on_stored=on_stored)
+        if route.sink:
+            rules.sink(route).write(line)
+
+# Function to process one spooled payload, retrying while KeyDB is unavailable
+# Returns False if stop was requested before the payload could be processed.
+def process_spooled_payload(data, stop):
+    try:
+        records = event_codec.decode_payload(data)
+    except event_codec.DecodeError as e:
+        logger.error(f"Error decoding spooled JSON: {str(e)}")
+        return True
+    delay = 1.0
+    while True:
+        try:
+            process_event(records)
+            return True
+        except (redis.RedisError, sqlite3.Error) as e:
+            logger.error(f"Device store unavailable, retrying in {delay:.0f}s: {str(e)}", extra={'rate_key': 'keydb_down'})
+            if stop.wait(delay):
+                return False
+            delay = min(delay * 2, SPOOL_RETRY_CAP)
+
+# Function to commit the spool once everything read so far is uploaded to S3
+# Returns False (and rewinds the spool for replay) if any upload failed since the last commit.
+def commit_spool(position, failed_before):
+    coalescer.flush_all()
+    archiver.flush_all()
+    upload_pool.wait_idle()
+    if upload_pool.metrics()['failed'] > failed_before:
+        logger.error("S3 uploads failed, replaying spool from the last commit")
+        # The replayed events must not be dropped as duplicates
+        deduplicator.clear()
+        spool.rewind()
+        return False
+    spool.commit(position)
+    stats = spool.stats()
+    logger.info(f"Spool committed - lag: {stats['lag_bytes']} bytes, segments: {stats['segments']}, "
+                f"dropped segments: {stats['dropped_segments']}")
+    return True
+
+# Function to drain the spool until stop is set and the spool is caught up
+def drain_spool(stop):
+    pending = None
+    last_commit = time.monotonic()
+    failed_before = upload_pool.metrics()['failed']
+    delay = 1.0
+    while True:
+        item = spool.read(timeout=1.0)
+        if item is None and stop.is_set():
+            break
+        if item is not None:
+            data, position = item
+            if not process_spooled_payload(data, stop):
+                return
+            pending = position
+        if pending and time.monotonic() - last_commit >= SPOOL_COMMIT_INTERVAL:
+            if commit_spool(pending, failed_before):
+                delay = 1.0
+            else:
+                # S3 is failing: wait before replaying the uncommitted records
+                if stop.wait(delay):
+                    return
+                delay = min(delay * 2, SPOOL_RETRY_CAP)
+            pending = None
+            last_commit = time.monotonic()
+            failed_before = upload_pool.metrics()['failed']
+    if pending:
+        commit_spool(pending, failed_before)
+
+# Function to pick the shard key of an event: the GUID of the device it is about (the
+# target when it is a DEVICE, like device_store.device_event_guid), otherwise the actor's.
+# All events of a device, its DEVICE updates included, then go to the same worker, whose
+# device cache is the one those updates invalidate.
+def shard_key(record):
+    if record.target_type == 'DEVICE' and record.target_guid:
+        return record.target_guid
+    if record.type == 'DEVICE':
+        return device_store.device_event_guid(record.event) or record.actor_guid
+    return record.actor_guid or record.target_guid
+
+# Function to hand the events of one payload to the shard workers, keyed by device GUID
+def dispatch_to_shards(event):
     try:
-        s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=object_key, Body=json.dumps(data))
-        logger.info(f"Successfully uploaded data to S3: {object_key}")
-    except Exception as e:
-        logger.error(f"Error uploading to S3: {str(e)}")
-        print(f"{Fore.RED}Error uploading to S3: {str(e)}")
-
-# Function to process each event
-def process_event(event_data):
-    events = event_data.get('events', [])
-    for event in events:
-        event_type = event.get('type', 'UNKNOWN')
-        change_type = event.get('change_type', 'UNKNOWN')
-        created_time = event.get('created_time', 'N/A')
-        logger.info(f"Processing event - Type: {event_type}, Change Type: {change_type}, Created Time: {created_time}")
-        print(f"{Fore.CYAN}Event Type: {event_type}, Change Type: {change_type}, Created Time: {created_time}")
-        
-        # Process THREAT type events
-        if event_type == 'THREAT':
-            threat = event.get('threat', {})
-            logger.info(f"Threat details - Type: {threat.get('type', 'N/A')}, Severity: {threat.get('severity', 'N/A')}, Status: {threat.get('status', 'N/A')}")
-            print(f"  Threat Type: {threat.get('type', 'N/A')}")
-            print(f"  Severity: {threat.get('severity', 'N/A')}")
-            print(f"  Status: {threat.get('status', 'N/A')}")
-            print(f"  Classifications: {json.dumps(threat.get('classifications', []), indent=2)}")
-            print(f"  Details: {json.dumps(threat.get('details', {}), indent=2)}")
-        
-        # Lookup user details from Redis using actor GUID
-        actor_guid = event.get('actor', {}).get('guid', 'N/A')
-        if actor_guid != 'N/A':
-            user_details = get_user_details_from_redis(actor_guid)
-            if user_details:
-                logger.info(f"User details - Email: {user_details.get('email', 'N/A')}, Device Model: {user_details.get('hardware', {}).get('model', 'N/A')}")
-                print(f"{Fore.GREEN}User Email: {user_details.get('email', 'N/A')}")
-                print(f"Device Model: {user_details.get('hardware', {}).get('model', 'N/A')}")
-        
-        print(f"  Actor GUID: {actor_guid}")
-        print(f"  Target GUID: {event.get('target', {}).get('guid', 'N/A')}")
-        print("\n" + "-"*60 + "\n")
-
-        # Upload event data to S3
-        object_key = f"events/{event_type}/{created_time}_{actor_guid}.json"
-        upload_to_s3(event, object_key)
+        records = event_codec.decode_payload(event.data)
+    except event_codec.DecodeError as e:
+        logger.error(f"Error decoding JSON: {str(e)}")
+        records = []
+    shard_workers.submit(event.id, [(shard_key(record), record.raw) for record in records])
+
+# Function to set up a shard worker process (--workers). Workers are spawned, so each one
+# imported this module afresh and has its own KeyDB connection, S3 upload pool and device cache.
+# Returns the worker's (process, close, acknowledged) functions.
+def start_shard_worker(shard, log_queue, headless, rules_file):
+    global HEADLESS, rules, pending
+    HEADLESS = headless
+    pending = PendingMessages()
+    log_setup.setup_queue_logging(log_queue)
+    rules = event_rules.load_rules(rules_file)
+    # The reader stops the workers once they have drained their queues
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    upload_pool.start()
+    archiver.start()
+    coalescer.start()
+
+    # Batches are acknowledged (by sequence number) once their archived events are in S3
+    def process(seq, payload):
+        ticket = pending.begin(seq)
+        process_event(event_codec.decode_payload(payload), ticket)
+        ticket.done()
+
+    def close():
+        coalescer.close()
+        archiver.close()
+        upload_pool.close()
+        rules.close()
+        logger.info(f"Shard {shard} device cache stats: {device_cache.stats()}")
+        logger.info(f"Shard {shard} de-duplication stats: {deduplicator.stats()}, coalesced: {coalescer.coalesced}")
+        # /metrics is served by the reader, so the worker's own metrics only go to the log
+        logger.info(f"Shard {shard} metrics:")
+        metrics.log_summary()
+
+    return process, close, pending.acknowledged
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream Lookout events, enrich them from KeyDB and archive them to S3")
+    parser.add_argument('--headless', action='store_true',
+                        help="service mode: no console output, structured JSON log lines")
+    parser.add_argument('--spool', default=os.getenv('SPOOL_DIR'),
+                        help="directory for a local spool of received events (survives S3/KeyDB outages)")
+    parser.add_argument('--rules', default=event_rules.EVENT_RULES_FILE,
+                        help="JSON file of event filtering and routing rules (see rules.example.json)")
+    parser.add_argument('--workers', type=int, default=SHARD_WORKERS,
+                        help="process events in this many worker processes, sharded by device (1 = in this process)")
+    parser.add_argument('--metrics-port', type=int, default=metrics.METRICS_PORT,
+                        help="serve Prometheus metrics on this local port (0 disables)")
+    args = parser.parse_args()
+    if args.workers > 1 and args.spool:
+        parser.error("--workers cannot be combined with --spool")
+    HEADLESS = args.headless
+    if args.workers <= 1 and not args.spool:
+        pending = PendingMessages()
+    # Worker processes send their log records to this process, which writes the log file
+    log_queue = SHARD_CONTEXT.Queue() if args.workers > 1 else None
+    log_listener = log_setup.setup_logging(LOG_FILE, MAX_LOG_SIZE, BACKUP_COUNT, json_lines=HEADLESS,
+                                           log_queue=log_queue)
+    metrics.start_http_server(args.metrics_port)
+    metrics_reporter = metrics.start_summary_logger()
+    rules = event_rules.load_rules(args.rules)
+
     # Main entry point
     APPLICATION_KEY = os.getenv('APPLICATION_KEY')
     if not APPLICATION_KEY:
@@ -152,9 +439,51 @@ if __name__ == "__main__":
         logger.error("S3_BUCKET_NAME is missing in environment variables.")
         raise ValueError("S3_BUCKET_NAME is missing in environment variables.")
     
-    access_token, expires_in = get_access_token(APPLICATION_KEY)
-    logger.info(f"Obtained access token, expires in {expires_in} seconds.")
-    print(f"{Fore.BLUE}Obtained access token, expires in {expires_in} seconds.")
+    token_manager = TokenManager(APPLICATION_KEY, TOKEN_URL, cache=make_token_cache(r))
+    token_manager.get()
+    console(f"{Fore.BLUE}Obtained access token.")
     
     # Start streaming and processing events, filtering by specific event types
-    stream_and_process_events(access_token, event_types="THREAT,DEVICE,AUDIT")
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    if args.workers > 1:
+        shard_workers = ShardPool(args.workers, start_shard_worker, args=(log_queue, HEADLESS, args.rules))
+        shard_workers.start()
+    else:
+        upload_pool.start()
+        archiver.start()
+        coalescer.start()
+    spool_stop = threading.Event()
+    spool_processor = None
+    if args.spool:
+        spool = Spool(args.spool)
+        spool_processor = threading.Thread(target=drain_spool, args=(spool_stop,), name='spool-processor')
+        spool_processor.start()
+    try:
+        stream_and_process_events(token_manager, event_types=rules.server_types())
+    finally:
+        # Let the spool processor catch up (or give up if downstream is unavailable)
+        if spool_processor:
+            spool_stop.set()
+            spool_processor.join()
+            spool.close()
+        if shard_workers:
+            # Let the workers finish their queues, then checkpoint what they processed
+            last_event_id = shard_workers.close()
+            if last_event_id:
+                make_checkpoint(r).save(last_event_id)
+        else:
+            # Flush held and partially filled batches, then wait for queued uploads to finish
+            coalescer.close()
+            archiver.close()
+            upload_pool.close()
+            logger.info(f"Device cache stats: {device_cache.stats()}")
+            logger.info(f"De-duplication stats: {deduplicator.stats()}, coalesced: {coalescer.coalesced}")
+            # Everything is uploaded now, so the checkpoint can move past the flushed batches
+            last_event_id = pending.acknowledged() if pending is not None else None
+            if last_event_id:
+                make_checkpoint(r).save(last_event_id)
+        rules.close()
+        if metrics_reporter:
+            metrics_reporter.set()
+        metrics.log_summary()
+        log_listener.stop()
@@ -1,76 +1,88 @@
 #!/usr/bin/python3
 import os
 import json
-import ast
-import redis
-import requests
 from dotenv import load_dotenv
-from sseclient import SSEClient
 from colorama import Fore, init
+import device_store
+from device_cache import DeviceCache
+from mra_client import TokenManager, make_token_cache
+from stream_consumer import consume_events, make_checkpoint
 
 # Load environment variables and initialize colorama
 load_dotenv('production.env')
 init(autoreset=True)
 
-# Initialize Redis (KeyDB) connection
+# Initialize Redis (KeyDB) connection, or the local device file selected by DEVICE_STORE
 KEYDB_HOST = os.getenv('KEYDB_HOST', 'localhost')
 KEYDB_PORT = int(os.getenv('KEYDB_PORT', 6379))
-r = redis.StrictRedis(host=KEYDB_HOST, port=KEYDB_PORT, decode_responses=True)
+r = device_store.open_store(KEYDB_HOST, KEYDB_PORT)
 
 # Constants
-LOOKOUT_API_URL = 'https://api.lookout.com'
+LOOKOUT_API_URL = os.getenv('LOOKOUT_API_URL', 'https://api.lookout.com')
 TOKEN_URL = f'{LOOKOUT_API_URL}/oauth2/token'
 EVENTS_STREAM_URL = f'{LOOKOUT_API_URL}/mra/stream/v2/events'
 
-# Authentication function
-def get_access_token(application_key):
-    headers = {
-        'Authorization': f'Bearer {application_key}',
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    data = {
-        'grant_type': 'client_credentials'
-    }
-    response = requests.post(TOKEN_URL, headers=headers, data=data)
-    response.raise_for_status()  # Raise error for bad status
-    token_info = response.json()
-    return token_info['access_token'], token_info['expires_in']
+# Function to handle a single SSE event from the stream
+def handle_sse_event(event):
+    if event.event == 'heartbeat':
+        return  # Ignore heartbeat events
+    elif event.event == 'events':
+        try:
+            event_data = json.loads(event.data)
+            process_event(event_data)
+        except json.JSONDecodeError as e:
+            print(f"{Fore.RED}Error decoding JSON: {str(e)}")
+    else:
+        print(f"{Fore.YELLOW}Unknown event received: {event}")
 
 # Function to stream and process events with specific types
-def stream_and_process_events(access_token, event_types="THREAT,DEVICE,AUDIT"):
-    headers = {'Authorization': f'Bearer {access_token}', 'Accept': 'text/event-stream'}
+# Reconnects automatically, refreshes the token before expiry and resumes from the
+# last checkpointed event id
+def stream_and_process_events(token_manager, event_types="THREAT,DEVICE,AUDIT"):
     params = {'types': event_types}  # Filter by specified event types
-    response = requests.get(EVENTS_STREAM_URL, headers=headers, params=params, stream=True)
-    response.raise_for_status()
-    client = SSEClient(response)
-    
-    for event in client.events():
-        if event.event == 'heartbeat':
-            continue  # Ignore heartbeat events
-        elif event.event == 'events':
-            try:
-                event_data = json.loads(event.data)
-                process_event(event_data)
-            except json.JSONDecodeError as e:
-                print(f"{Fore.RED}Error decoding JSON: {str(e)}")
-        else:
-            print(f"{Fore.YELLOW}Unknown event received: {event}")
+    consume_events(EVENTS_STREAM_URL, token_manager, handle_sse_event,
+                   checkpoint=make_checkpoint(r), params=params)
 
 # Function to get user details from Redis
 def get_user_details_from_redis(guid):
-    user_data = r.get(guid)
+    try:
+        user_data = device_store.get_device(r, guid)
+    except ValueError as e:
+        print(f"{Fore.RED}Error evaluating data for GUID {guid}: {str(e)}")
+        return None
     if user_data:
-        try:
-            return ast.literal_eval(user_data)
-        except (ValueError, SyntaxError) as e:
-            print(f"{Fore.RED}Error evaluating data for GUID {guid}: {str(e)}")
-            return None
+        return user_data
     print(f"{Fore.RED}No user data found in Redis for GUID: {guid}")
     return None
 
+# Function to get user details for several GUIDs from Redis in one round trip
+def get_users_details_from_redis(guids):
+    users = device_store.get_devices(r, guids)
+    for guid in [g for g, user in users.items() if not user]:
+        print(f"{Fore.RED}No user data found in Redis for GUID: {guid}")
+    return users
+
+# Function to collect the device GUIDs referenced by a payload (actors, and DEVICE targets)
+def collect_device_guids(events):
+    guids = []
+    for event in events:
+        actor_guid = event.get('actor', {}).get('guid')
+        if actor_guid:
+            guids.append(actor_guid)
+        target = event.get('target', {})
+        if target.get('type') == 'DEVICE' and target.get('guid'):
+            guids.append(target['guid'])
+    return guids
+
+# In-process cache in front of KeyDB; misses are cached too so repeated unknown GUIDs
+# don't cost a round trip and a warning on every event
+device_cache = DeviceCache(get_user_details_from_redis, bulk_loader=get_users_details_from_redis)
+
 # Function to process each event
 def process_event(event_data):
     events = event_data.get('events', [])
+    # Resolve every device referenced by the payload with a single MGET up front
+    device_cache.get_many(collect_device_guids(events))
     for event in events:
         event_type = event.get('type', 'UNKNOWN')
         change_type = event.get('change_type', 'UNKNOWN')
@@ -86,10 +98,17 @@ def process_event(event_data):
             print(f"  Classifications: {json.dumps(threat.get('classifications', []), indent=2)}")
             print(f"  Details: {json.dumps(threat.get('details', {}), indent=2)}")
         
+        # Keep the KeyDB device cache in sync with DEVICE events
+        elif event_type == 'DEVICE':
+            result, device_guid = device_store.apply_device_event(r, event)
+            if result:
+                device_cache.invalidate(device_guid)
+                print(f"  Device cache {result}")
+        
         # Lookup user details from Redis using actor GUID
         actor_guid = event.get('actor', {}).get('guid', 'N/A')
         if actor_guid != 'N/A':
-            user_details = get_user_details_from_redis(actor_guid)
+            user_details = device_cache.get(actor_guid)
             if user_details:
                 print(f"{Fore.GREEN}User Email: {user_details.get('email', 'N/A')}")
                 print(f"Device Model: {user_details.get('hardware', {}).get('model', 'N/A')}")
@@ -104,9 +123,10 @@ if __name__ == "__main__":
     if not APPLICATION_KEY:
         raise ValueError("APPLICATION_KEY is missing in environment variables.")
     
-    access_token, expires_in = get_access_token(APPLICATION_KEY)
-    print(f"{Fore.BLUE}Obtained access token, expires in {expires_in} seconds.")
+    token_manager = TokenManager(APPLICATION_KEY, TOKEN_URL, cache=make_token_cache(r))
+    token_manager.get()
+    print(f"{Fore.BLUE}Obtained access token.")
     
     # Start streaming and processing events, filtering by specific event types
-    stream_and_process_events(access_token, event_types="THREAT,DEVICE,AUDIT")
+    stream_and_process_events(token_manager, event_types="THREAT,DEVICE,AUDIT")
 
@@ -1,18 +1,18 @@
 import os
 import json
 import time
-import redis
-import requests
 from dotenv import load_dotenv
 from sseclient import SSEClient
+import device_store
+import mra_client
 
 # Load environment variables
 load_dotenv('production.env')
 
-# Initialize Redis (KeyDB) connection
+# Initialize Redis (KeyDB) connection, or the local device file selected by DEVICE_STORE
 KEYDB_HOST = os.getenv('KEYDB_HOST', 'localhost')
 KEYDB_PORT = int(os.getenv('KEYDB_PORT', 6379))
-r = redis.StrictRedis(host=KEYDB_HOST, port=KEYDB_PORT, decode_responses=True)
+r = device_store.open_store(KEYDB_HOST, KEYDB_PORT)
 
 # Constants
 LOOKOUT_API_URL = 'https://api.lookout.com'
@@ -20,24 +20,11 @@ TOKEN_URL = f'{LOOKOUT_API_URL}/oauth2/token'
 DEVICES_URL = f'{LOOKOUT_API_URL}/mra/api/v2/device'
 EVENTS_STREAM_URL = f'{LOOKOUT_API_URL}/mra/stream/v2/events'
 
-# Authentication function
-def get_access_token(application_key):
-    headers = {
-        'Authorization': f'Bearer {application_key}',
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    data = {
-        'grant_type': 'client_credentials'
-    }
-    response = requests.post(TOKEN_URL, headers=headers, data=data)
-    response.raise_for_status()  # Raise error for bad status
-    token_info = response.json()
-    return token_info['access_token'], token_info['expires_in']
-
 # Function to stream and process events
-def stream_and_process_events(access_token):
-    headers = {'Authorization': f'Bearer {access_token}', 'Accept': 'text/event-stream'}
-    response = requests.get(EVENTS_STREAM_URL, headers=headers, stream=True)
+def stream_and_process_events(token_manager):
+    headers = {'Accept': 'text/event-stream'}
+    response = mra_client.api_request('GET', EVENTS_STREAM_URL, token_manager, headers=headers, stream=True,
+                                      timeout=(mra_client.HTTP_TIMEOUT[0], None))
     response.raise_for_status()
     client = SSEClient(response)
     for event in client.events():
@@ -69,10 +56,11 @@ def process_event(event_data):
 
 # Function to get device details from KeyDB
 def get_device_details_from_keydb(guid):
-    device_data = r.get(guid)
-    if device_data:
-        return json.loads(device_data)
-    return None
+    try:
+        return device_store.get_device(r, guid)
+    except ValueError as e:
+        print(f"Error decoding device details for GUID {guid}: {str(e)}")
+        return None
 
 # Function to report or log threat with details
 def report_threat(event_data, device_details):
@@ -90,9 +78,10 @@ if __name__ == "__main__":
     if not APPLICATION_KEY:
         raise ValueError("APPLICATION_KEY is missing in environment variables.")
     
-    access_token, expires_in = get_access_token(APPLICATION_KEY)
-    print(f"Obtained access token, expires in {expires_in} seconds.")
+    token_manager = mra_client.TokenManager(APPLICATION_KEY, TOKEN_URL, cache=mra_client.make_token_cache(r))
+    token_manager.get()
+    print(f"Obtained access token, expires in {token_manager.expires_in():.0f} seconds.")
     
     # Start streaming and processing events
-    stream_and_process_events(access_token)
+    stream_and_process_events(token_manager)
 
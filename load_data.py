@@ -1,79 +1,121 @@
-import requests
-import redis
 import time
 import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import device_store
+import metrics
+import mra_client
 
 # Load environment variables
 load_dotenv('production.env')
 
 # Configuration
-LOOKOUT_API_URL = "https://api.lookout.com"
+LOOKOUT_API_URL = os.environ.get('LOOKOUT_API_URL', "https://api.lookout.com")
 TOKEN_URL = f"{LOOKOUT_API_URL}/oauth2/token"
 DEVICES_URL = f"{LOOKOUT_API_URL}/mra/api/v2/devices"
-KEYDB_HOST = "127.0.0.1"
-KEYDB_PORT = 6379
+DEVICES_PAGE_SIZE = 1000  # largest page size accepted by /mra/api/v2/devices
+KEYDB_HOST = os.environ.get('KEYDB_HOST', "127.0.0.1")
+KEYDB_PORT = int(os.environ.get('KEYDB_PORT', 6379))
+HIGH_WATER_MARK_KEY = 'load_data:last_oid'  # highest device oid stored so far
+
+# Loader metrics, served on /metrics with --metrics-port (or METRICS_PORT)
+DEVICES_LOADED = metrics.Counter('load_data_devices_total', 'Devices written to KeyDB')
+PAGE_FETCH_SECONDS = metrics.Histogram('load_data_page_fetch_seconds', 'Latency of one devices page request')
+PAGE_STORE_SECONDS = metrics.Histogram('load_data_page_store_seconds', 'Time to write one page of devices to KeyDB')
 
 # Get the application key from environment variables
 APPLICATION_KEY = os.environ.get('APPLICATION_KEY')
 if not APPLICATION_KEY:
     raise ValueError("APPLICATION_KEY environment variable is not set")
 
-# Connect to KeyDB
-r = redis.StrictRedis(host=KEYDB_HOST, port=KEYDB_PORT, decode_responses=True)
+# Connect to KeyDB, or to the local device file selected by DEVICE_STORE
+r = device_store.open_store(KEYDB_HOST, KEYDB_PORT)
 
-# Function to obtain an access token
-def get_access_token(application_key):
-    headers = {
-        'Authorization': f'Bearer {application_key}',
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    data = {
-        'grant_type': 'client_credentials'
-    }
-    response = requests.post(TOKEN_URL, headers=headers, data=data)
-    response.raise_for_status()  # Raise error for bad status
-    token_info = response.json()
-    return token_info['access_token'], token_info['expires_in']
+# Function to read the persisted high-water mark (last stored device oid)
+def get_high_water_mark():
+    value = r.get(HIGH_WATER_MARK_KEY)
+    return int(value) if value else None
+
+# Function to persist the high-water mark
+def set_high_water_mark(oid):
+    r.set(HIGH_WATER_MARK_KEY, oid)
+
+# Function to write a page of devices and advance the high-water mark
+def store_page(devices):
+    with PAGE_STORE_SECONDS.time():
+        device_store.put_devices(r, devices)
+        set_high_water_mark(devices[-1]['oid'])
+    DEVICES_LOADED.inc(len(devices))
 
 # Function to get device data and store in KeyDB
-def get_devices_data(access_token, limit=100):
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Accept': 'application/json'
-    }
+# Pages are cursor-based (by oid), so fetching is sequential; the KeyDB write of
+# each page runs on a background thread while the next page is being fetched.
+# Pass start_oid to only fetch devices added after that oid. Requests go through the
+# shared keep-alive session of mra_client, which waits out 429s (honouring Retry-After)
+# and refreshes the token when it expires during a long load.
+def get_devices_data(token_manager, limit=DEVICES_PAGE_SIZE, start_oid=None):
     params = {
         'limit': limit
     }
-    last_oid = None
-    while True:
-        if last_oid:
-            params['oid'] = last_oid
-        
-        response = requests.get(DEVICES_URL, headers=headers, params=params)
-        if response.status_code == 429:
-            # Handle rate limiting by waiting before retrying
-            time.sleep(10)
-            continue
-        
-        response.raise_for_status()
-        data = response.json()
-        devices = data.get('devices', [])
-        
-        if not devices:
-            break
-        
-        for device in devices:
-            guid = device['guid']
-            r.set(guid, str(device))
-            last_oid = device['oid']
-        
-        if len(devices) < limit:
-            break
+    last_oid = start_oid
+    total = 0
+    pending_write = None
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        while True:
+            if last_oid:
+                params['oid'] = last_oid
+
+            with PAGE_FETCH_SECONDS.time():
+                response = mra_client.api_request('GET', DEVICES_URL, token_manager, params=params)
+            response.raise_for_status()
+            data = response.json()
+            devices = data.get('devices', [])
+
+            if not devices:
+                break
+
+            # Wait for the previous page to be written before queueing this one
+            if pending_write:
+                pending_write.result()
+            pending_write = writer.submit(store_page, devices)
+            last_oid = devices[-1]['oid']
+            total += len(devices)
+
+            if len(devices) < limit:
+                break
+
+        if pending_write:
+            pending_write.result()
+
+    elapsed = time.monotonic() - start
+    rate = total / elapsed if elapsed > 0 else 0.0
+    print(f"Stored {total} devices in {elapsed:.1f} seconds ({rate:.0f} devices/sec).")
+    return total
 
 if __name__ == "__main__":
-    access_token, expires_in = get_access_token(APPLICATION_KEY)
-    print(f"Obtained access token, expires in {expires_in} seconds.")
-    
-    get_devices_data(access_token, limit=100)
-    print("Device data has been stored in KeyDB.")
+    parser = argparse.ArgumentParser(description="Load Lookout device data into KeyDB")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only fetch devices added since the last run (updates arrive via DEVICE stream events)")
+    parser.add_argument('--metrics-port', type=int, default=metrics.METRICS_PORT,
+                        help="serve Prometheus metrics on this local port while loading (0 disables)")
+    args = parser.parse_args()
+    metrics.start_http_server(args.metrics_port)
+
+    token_manager = mra_client.TokenManager(APPLICATION_KEY, TOKEN_URL, cache=mra_client.make_token_cache(r))
+    token_manager.get()
+    print(f"Obtained access token, expires in {token_manager.expires_in():.0f} seconds.")
+
+    start_oid = None
+    if args.incremental:
+        start_oid = get_high_water_mark()
+        if start_oid is None:
+            print("No high-water mark found, running a full load.")
+        else:
+            print(f"Resuming from device oid {start_oid}.")
+
+    get_devices_data(token_manager, start_oid=start_oid)
+    print(f"Device data has been stored in {'KeyDB' if device_store.DEVICE_STORE == 'keydb' else device_store.DEVICE_STORE}.")
+    print(f"Page fetch latency: {PAGE_FETCH_SECONDS.summary()}")
+    print(f"Page store latency: {PAGE_STORE_SECONDS.summary()}")
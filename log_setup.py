@@ -0,0 +1,88 @@
+import json
+import time
+import queue
+import logging
+import threading
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+# Warnings tagged with the same rate_key are limited to RATE_LIMIT_BURST per interval
+RATE_LIMIT_INTERVAL = 60.0  # seconds
+RATE_LIMIT_BURST = 5
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'rate_key'}
+
+
+# Formats records as one compact JSON object per line; extra=... fields are included
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(',', ':'), default=str)
+
+
+# Drops repeats of records logged with extra={'rate_key': ...} beyond a burst per interval,
+# and reports how many were dropped when the next interval starts
+class RateLimitFilter(logging.Filter):
+    def __init__(self, interval=RATE_LIMIT_INTERVAL, burst=RATE_LIMIT_BURST):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self._windows = {}  # rate_key -> [window start, count, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'rate_key', None)
+        if key is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+                return True
+            window[1] += 1
+            if window[1] <= self.burst:
+                return True
+            window[2] += 1
+            return False
+
+
+# Function to route all logging through a queue so file writes happen on a background thread
+# Returns the QueueListener, which must be stopped on shutdown to flush pending records.
+# Pass a multiprocessing queue as log_queue to also receive the records of worker processes
+# (see setup_queue_logging).
+def setup_logging(log_file, max_bytes, backup_count, json_lines=False, level=logging.INFO, log_queue=None):
+    file_handler = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter(TEXT_FORMAT))
+
+    if log_queue is None:
+        log_queue = queue.SimpleQueue()
+    setup_queue_logging(log_queue, level)
+
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+# Function to send this process's logging to a queue; worker processes call it with the
+# multiprocessing queue that the log-writing process passed to setup_logging
+def setup_queue_logging(log_queue, level=logging.INFO):
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter())
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    root_logger.addHandler(queue_handler)
@@ -0,0 +1,251 @@
+import os
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Metrics configuration
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))  # 0 disables the /metrics endpoint
+METRICS_ADDR = os.getenv('METRICS_ADDR', '127.0.0.1')
+METRICS_LOG_INTERVAL = float(os.getenv('METRICS_LOG_INTERVAL', 0))  # seconds, 0 disables
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Every metric created in this process, in creation order
+_registry = []
+_registry_lock = threading.Lock()
+
+
+# Function to add a metric to the registry; names must be unique within a process
+def _register(metric):
+    with _registry_lock:
+        if any(existing.name == metric.name for existing in _registry):
+            raise ValueError(f"Duplicate metric name: {metric.name}")
+        _registry.append(metric)
+    return metric
+
+
+# Function to remove metrics from the registry, e.g. those of an imported module that
+# this process never updates (they would be exported as stuck at 0)
+def unregister(*metrics):
+    with _registry_lock:
+        _registry[:] = [metric for metric in _registry if metric not in metrics]
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value != value:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Monotonic counter, optionally split by labels: c.inc(), c.inc(5, type='THREAT')
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _register(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.labelnames:
+            values[()] = 0
+        return [(self.name, key, None, value) for key, value in sorted(values.items())]
+
+    def summary(self):
+        with self._lock:
+            values = dict(self._values)
+        if not self.labelnames:
+            return str(values.get((), 0))
+        return ', '.join(f"{'/'.join(key)}={value}" for key, value in sorted(values.items())) or '0'
+
+
+# Value read from a callback at scrape time (queue depth, cache hit ratio, spool lag)
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help, func):
+        self.name = name
+        self.help = help
+        self.labelnames = ()
+        self.func = func
+        _register(self)
+
+    def value(self):
+        try:
+            return self.func()
+        except Exception as e:
+            logger.warning(f"Error reading gauge {self.name}: {str(e)}", extra={'rate_key': 'gauge_error'})
+            return float('nan')
+
+    def samples(self):
+        return [(self.name, (), None, self.value())]
+
+    def summary(self):
+        value = self.value()
+        return f'{value:.3f}' if isinstance(value, float) else str(value)
+
+
+# Cumulative histogram (Prometheus buckets), used for latencies in seconds
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._lock = threading.Lock()
+        _register(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    # Context manager that observes the elapsed time of its block
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _snapshot(self):
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+
+    def samples(self):
+        samples = []
+        for key, (counts, total, count) in sorted(self._snapshot().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append((f'{self.name}_bucket', key, ('le', _format_value(bound)), cumulative))
+            samples.append((f'{self.name}_sum', key, None, total))
+            samples.append((f'{self.name}_count', key, None, count))
+        return samples
+
+    # Estimate a quantile from the buckets (linear interpolation, like histogram_quantile)
+    def quantile(self, q, counts):
+        count = sum(counts)
+        if not count:
+            return 0.0
+        rank = q * count
+        cumulative = 0
+        for i, bucket_count in enumerate(counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+    def summary(self):
+        parts = []
+        for key, (counts, total, count) in sorted(self._snapshot().items()):
+            label = '/'.join(key) + ': ' if key else ''
+            parts.append(f"{label}n={count} avg={total / count * 1000:.1f}ms "
+                         f"p50={self.quantile(0.5, counts) * 1000:.1f}ms p99={self.quantile(0.99, counts) * 1000:.1f}ms")
+        return '; '.join(parts) or 'n=0'
+
+
+# Function to render every registered metric in the Prometheus text exposition format
+def render():
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, key, extra, value in metric.samples():
+            lines.append(f'{name}{_format_labels(metric.labelnames, key, extra)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+# Function to log a one-line summary of every registered metric
+def log_summary():
+    with _registry_lock:
+        metrics = list(_registry)
+    for metric in metrics:
+        logger.info(f"Metric {metric.name}: {metric.summary()}")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are not worth a log line each
+
+
+# Function to serve /metrics on a background thread; returns the server (None if disabled)
+def start_http_server(port=METRICS_PORT, addr=METRICS_ADDR):
+    if not port:
+        return None
+    server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info(f"Serving metrics on http://{addr}:{server.server_address[1]}/metrics")
+    return server
+
+
+# Function to log metric summaries every interval seconds on a background thread
+# Returns an Event that stops the reporter when set (None if disabled).
+def start_summary_logger(interval=METRICS_LOG_INTERVAL):
+    if interval <= 0:
+        return None
+    stop = threading.Event()
+
+    def report():
+        while not stop.wait(interval):
+            log_summary()
+
+    threading.Thread(target=report, name='metrics-summary', daemon=True).start()
+    return stop
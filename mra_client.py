@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import random
+import hashlib
+import logging
+import tempfile
+import threading
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+# fcntl (POSIX only) serializes token cache updates between processes
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# MRA client configuration
+TOKEN_REFRESH_MARGIN = 120  # seconds before expiry to fetch a new token
+TOKEN_CACHE = os.getenv('TOKEN_CACHE', 'mra.token')  # file path, "keydb", or empty to disable
+TOKEN_CACHE_KEY = os.getenv('TOKEN_CACHE_KEY', 'mra:token')  # KeyDB key prefix with TOKEN_CACHE=keydb
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))  # keep-alive connections per host
+HTTP_TIMEOUT = (10, 60)  # connect, read seconds for API calls
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 5))
+HTTP_BACKOFF_BASE = 1.0  # seconds
+HTTP_BACKOFF_CAP = 60.0  # seconds
+HTTP_RETRY_AFTER_CAP = 300.0  # longest Retry-After honoured, seconds
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+# Client metrics
+TOKEN_REFRESHES = metrics.Counter('token_refreshes_total', 'Access tokens obtained')
+TOKEN_CACHE_HITS = metrics.Counter('token_cache_hits_total', 'Access tokens reused from the token cache')
+HTTP_RETRIES = metrics.Counter('http_retries_total', 'API requests retried, by status', ['status'])
+
+
+# Function to create a requests Session keeping up to pool_size connections per host alive
+def make_session(pool_size=HTTP_POOL_SIZE):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# Shared by every request in the process that is not given its own session
+shared_session = make_session()
+
+
+# Function to read a response's Retry-After header (seconds or an HTTP date) as seconds
+# Returns None if the header is missing or malformed.
+def retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), HTTP_RETRY_AFTER_CAP)
+
+
+# Function to send a request, retrying connection errors, 429 and 5xx responses
+# The wait is the server's Retry-After when it sends one, jittered exponential backoff
+# otherwise. Returns the last response, whatever its status.
+def request(method, url, session=None, max_retries=HTTP_MAX_RETRIES, **kwargs):
+    session = session or shared_session
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    for attempt in range(max_retries + 1):
+        delay = random.uniform(0, min(HTTP_BACKOFF_CAP, HTTP_BACKOFF_BASE * 2 ** attempt))
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == max_retries:
+                raise
+            status = 'error'
+            reason = str(e)
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt == max_retries:
+                return response
+            status = response.status_code
+            reason = f"HTTP {status}"
+            server_delay = retry_after(response)
+            if server_delay is not None:
+                delay = server_delay
+            response.close()
+        HTTP_RETRIES.inc(status=str(status))
+        logger.warning(f"{method} {url} failed ({reason}), retrying in {delay:.1f}s "
+                       f"(attempt {attempt + 1} of {max_retries})", extra={'rate_key': 'http_retry'})
+        time.sleep(delay)
+
+
+# Function to send an API request with the manager's bearer token
+# A 401 invalidates the token, and the request is retried once with a new one.
+def api_request(method, url, token_manager, session=None, headers=None, **kwargs):
+    for attempt in range(2):
+        request_headers = {'Authorization': f'Bearer {token_manager.get()}', 'Accept': 'application/json'}
+        request_headers.update(headers or {})
+        response = request(method, url, session=session, headers=request_headers, **kwargs)
+        if response.status_code != 401 or attempt:
+            return response
+        response.close()
+        token_manager.invalidate()
+
+
+# Stores access tokens in a local JSON file readable by its owner only, one entry per
+# application key (identified by a hash, the key itself is never written)
+# Processes sharing the file update it under an flock on "<path>.lock", and each write
+# goes to its own temporary file, so concurrent saves never lose each other's entries.
+class FileTokenCache:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def load(self, key_id):
+        entry = self._read().get(key_id)
+        return (entry['access_token'], entry['expires_at']) if entry else None
+
+    def save(self, key_id, token, expires_at):
+        with self._lock, open(os.open(f"{self.path}.lock", os.O_WRONLY | os.O_CREAT, 0o600), 'w') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)  # released when lock_file is closed
+            now = time.time()
+            entries = {k: v for k, v in self._read().items() if v.get('expires_at', 0) > now}
+            if token is None:
+                entries.pop(key_id, None)
+            else:
+                entries[key_id] = {'access_token': token, 'expires_at': expires_at}
+            # mkstemp creates the file readable by its owner only
+            fd, tmp_path = tempfile.mkstemp(prefix=f"{os.path.basename(self.path)}.", suffix='.tmp',
+                                            dir=os.path.dirname(self.path) or '.')
+            try:
+                with open(fd, 'w') as f:
+                    json.dump(entries, f)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+    def delete(self, key_id):
+        self.save(key_id, None, 0)
+
+
+# Stores access tokens in KeyDB, shared by every process using the same KeyDB; the keys
+# expire with the token
+class RedisTokenCache:
+    def __init__(self, r, key=TOKEN_CACHE_KEY):
+        self.r = r
+        self.key = key
+
+    def load(self, key_id):
+        raw = self.r.get(f"{self.key}:{key_id}")
+        if not raw:
+            return None
+        entry = json.loads(raw)
+        return entry['access_token'], entry['expires_at']
+
+    def save(self, key_id, token, expires_at):
+        ttl = int(expires_at - time.time())
+        if ttl > 0:
+            self.r.set(f"{self.key}:{key_id}", json.dumps({'access_token': token, 'expires_at': expires_at}), ex=ttl)
+
+    def delete(self, key_id):
+        self.r.delete(f"{self.key}:{key_id}")
+
+
+# Function to build the token cache selected by TOKEN_CACHE (None if caching is disabled)
+# r is a synchronous KeyDB client, required for TOKEN_CACHE=keydb.
+def make_token_cache(r=None, location=TOKEN_CACHE):
+    if not location:
+        return None
+    if location == 'keydb':
+        if r is None:
+            logger.warning("TOKEN_CACHE=keydb but no KeyDB connection is available, tokens are not cached")
+            return None
+        return RedisTokenCache(r)
+    return FileTokenCache(location)
+
+
+# Caches an OAuth access token and fetches a new one shortly before it expires.
+# With a cache, a token obtained by an earlier run (or another process) is reused
+# until refresh_margin seconds before it expires.
+class TokenManager:
+    def __init__(self, application_key, token_url, refresh_margin=TOKEN_REFRESH_MARGIN, session=None, cache=None):
+        self.application_key = application_key
+        self.token_url = token_url
+        self.refresh_margin = refresh_margin
+        self.session = session
+        self.cache = cache
+        self._key_id = hashlib.sha256(f"{token_url}\n{application_key}".encode('utf-8')).hexdigest()[:32]
+        self._token = None
+        self._expires_at = 0.0  # wall-clock time, so cached tokens stay valid across processes
+        self._lock = threading.Lock()
+
+    def _load_cached(self):
+        try:
+            cached = self.cache.load(self._key_id)
+        except Exception as e:
+            logger.warning(f"Error reading the token cache: {str(e)}")
+            return False
+        if not cached or cached[1] - self.refresh_margin <= time.time():
+            return False
+        self._token, self._expires_at = cached
+        TOKEN_CACHE_HITS.inc()
+        logger.info(f"Reusing cached access token, expires in {self.expires_in():.0f} seconds.")
+        return True
+
+    def _fetch(self):
+        if self.cache and self._load_cached():
+            return
+        headers = {
+            'Authorization': f'Bearer {self.application_key}',
+            'Content-Type': 'application/x-www-form-urlencoded'
+        }
+        data = {
+            'grant_type': 'client_credentials'
+        }
+        response = request('POST', self.token_url, session=self.session, headers=headers, data=data)
+        response.raise_for_status()  # Raise error for bad status
+        token_info = response.json()
+        self._token = token_info['access_token']
+        self._expires_at = time.time() + token_info['expires_in']
+        TOKEN_REFRESHES.inc()
+        logger.info(f"Obtained access token, expires in {token_info['expires_in']} seconds.")
+        if self.cache:
+            try:
+                self.cache.save(self._key_id, self._token, self._expires_at)
+            except Exception as e:
+                logger.warning(f"Error writing the token cache: {str(e)}")
+
+    # Seconds until the current token expires
+    def expires_in(self):
+        return self._expires_at - time.time()
+
+    # Seconds until the current token should be replaced
+    def remaining(self):
+        return self.expires_in() - self.refresh_margin
+
+    def get(self):
+        with self._lock:
+            if self._token is None or self.remaining() <= 0:
+                self._fetch()
+            return self._token
+
+    # Drop the current token (e.g. after a 401), here and in the cache
+    def invalidate(self):
+        with self._lock:
+            self._token = None
+            if self.cache:
+                try:
+                    self.cache.delete(self._key_id)
+                except Exception as e:
+                    logger.warning(f"Error writing the token cache: {str(e)}")
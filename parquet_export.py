@@ -0,0 +1,250 @@
+import os
+import argparse
+from collections import deque
+from datetime import date, datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+from dotenv import load_dotenv
+import event_codec
+import s3_archiver
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Load environment variables
+load_dotenv('production.env')
+
+# Configuration
+S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME')
+S3_REGION = os.getenv('S3_REGION', 'us-east-1')
+EXPORT_OUTPUT = os.getenv('EXPORT_OUTPUT', 'export')  # local directory or s3://bucket/prefix
+EXPORT_ROWS_PER_FILE = int(os.getenv('EXPORT_ROWS_PER_FILE', 500000))
+EXPORT_COMPRESSION = os.getenv('EXPORT_COMPRESSION', 'zstd')
+EXPORT_READ_WORKERS = int(os.getenv('EXPORT_READ_WORKERS', 16))  # archived objects downloaded concurrently
+EVENT_TYPES = 'THREAT,DEVICE,AUDIT'
+
+# Flattened columns: (name, kind, path of the value in the archived event)
+# Kinds: string, timestamp, strings (list of strings) and json (nested value kept as a JSON
+# string, for fields whose shape differs per threat or audit type).
+COLUMNS = [
+    ('id', 'string', ('id',)),
+    ('change_type', 'string', ('change_type',)),
+    ('created_time', 'timestamp', ('created_time',)),
+    ('actor_type', 'string', ('actor', 'type')),
+    ('actor_guid', 'string', ('actor', 'guid')),
+    ('target_type', 'string', ('target', 'type')),
+    ('target_guid', 'string', ('target', 'guid')),
+    ('threat_guid', 'string', ('threat', 'guid')),
+    ('threat_type', 'string', ('threat', 'type')),
+    ('threat_severity', 'string', ('threat', 'severity')),
+    ('threat_status', 'string', ('threat', 'status')),
+    ('threat_classifications', 'strings', ('threat', 'classifications')),
+    ('threat_details', 'json', ('threat', 'details')),
+    ('device_guid', 'string', ('device', 'guid')),
+    ('device_email', 'string', ('device', 'email')),
+    ('device_platform', 'string', ('device', 'platform')),
+    ('device_manufacturer', 'string', ('device', 'hardware', 'manufacturer')),
+    ('device_model', 'string', ('device', 'hardware', 'model')),
+    ('device_os_version', 'string', ('device', 'software', 'os_version')),
+    ('device_activation_status', 'string', ('device', 'activation_status')),
+    ('device_security_status', 'string', ('device', 'security_status')),
+    ('audit_type', 'string', ('audit', 'type')),
+    ('audit_attribute_changes', 'json', ('audit', 'attribute_changes')),
+    # Actor's device details added by the viewer at archival time
+    ('actor_email', 'string', ('enrichment', 'email')),
+    ('actor_device_model', 'string', ('enrichment', 'device_model')),
+    ('actor_platform', 'string', ('enrichment', 'platform')),
+]
+
+
+# Function to build the Arrow schema of the exported files
+def make_schema():
+    kinds = {
+        'string': pa.string(),
+        'timestamp': pa.timestamp('ms', tz='UTC'),
+        'strings': pa.list_(pa.string()),
+        'json': pa.string(),
+    }
+    return pa.schema([(name, kinds[kind]) for name, kind, _ in COLUMNS])
+
+
+def _lookup(event, path):
+    value = event
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+# Function to convert a value to its column kind (None if it is missing or malformed)
+def _convert(kind, value):
+    if value is None:
+        return None
+    if kind == 'string':
+        return value if isinstance(value, str) else str(value)
+    if kind == 'timestamp':
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except (ValueError, AttributeError):
+            return None
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    if kind == 'strings':
+        return [str(item) for item in value] if isinstance(value, list) else [str(value)]
+    return event_codec.dumps(value).decode('utf-8')
+
+
+# Rolls flattened events into columnar files for one (type, day) partition, starting a new
+# file every rows_per_file events. Files are named part-00000, part-00001, ... so exporting
+# the same day again replaces its files instead of adding duplicates.
+class PartitionWriter:
+    def __init__(self, output, event_type, day, file_format='parquet', rows_per_file=EXPORT_ROWS_PER_FILE,
+                 compression=EXPORT_COMPRESSION):
+        self.output = output
+        self.partition = f"type={event_type}/dt={day:%Y-%m-%d}"
+        self.file_format = file_format
+        self.rows_per_file = rows_per_file
+        self.compression = compression
+        self.schema = make_schema()
+        self.files = 0
+        self.rows = 0
+        self._columns = {name: [] for name, _, _ in COLUMNS}
+        self._pending = 0
+
+    def add(self, event):
+        for name, kind, path in COLUMNS:
+            self._columns[name].append(_convert(kind, _lookup(event, path)))
+        self._pending += 1
+        if self._pending >= self.rows_per_file:
+            self.flush()
+
+    # Write the buffered events as one file
+    def flush(self):
+        if not self._pending:
+            return
+        table = pa.Table.from_pydict(self._columns, schema=self.schema)
+        sink = pa.BufferOutputStream()
+        if self.file_format == 'arrow':
+            options = pa.ipc.IpcWriteOptions(compression=self.compression)
+            with pa.ipc.new_file(sink, self.schema, options=options) as writer:
+                writer.write_table(table)
+        else:
+            pq.write_table(table, sink, compression=self.compression)
+        name = f"{self.partition}/part-{self.files:05d}.{self.file_format}"
+        self.output.write(name, sink.getvalue().to_pybytes())
+        self.files += 1
+        self.rows += self._pending
+        self._columns = {name: [] for name, _, _ in COLUMNS}
+        self._pending = 0
+
+
+# Writes exported files under a local directory
+class LocalOutput:
+    def __init__(self, root):
+        self.root = root
+
+    def write(self, name, body):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(body)
+        os.replace(path + '.tmp', path)  # readers never see a partial file
+
+
+# Writes exported files under an S3 prefix
+class S3Output:
+    def __init__(self, s3_client, bucket, prefix):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+
+    def write(self, name, body):
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.prefix + name, Body=body)
+
+
+# Function to open the output named by a local path or an s3://bucket/prefix URL
+def open_output(location, s3_client):
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        return S3Output(s3_client, bucket, prefix)
+    return LocalOutput(location)
+
+
+# Function to list the archived objects of an event type for one day: the batches, then
+# the per-event objects that were written before batching
+def list_day_keys(s3_client, bucket, event_type, day, key_prefix=''):
+    yield from s3_archiver.list_batch_keys(s3_client, bucket, event_type, day, day, key_prefix)
+    for prefix in s3_archiver.legacy_day_prefixes(event_type, day, day, key_prefix):
+        yield from s3_archiver.list_legacy_keys(s3_client, bucket, prefix)
+
+
+# Function to read objects on a thread pool, in key order, with at most `window` reads
+# in flight (pool.map would list every key first and could hold every result in memory)
+def read_ahead(pool, read, keys, window):
+    pending = deque()
+    for object_key in keys:
+        pending.append(pool.submit(read, object_key))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+# Function to export one event type for one day; returns (events, files) written
+# With a thread pool, the objects are downloaded concurrently (legacy objects hold one
+# event each, so reading them one at a time would be dominated by request latency),
+# `window` of them at most ahead of the writer.
+def export_partition(s3_client, bucket, output, event_type, day, file_format='parquet', key_prefix='', pool=None,
+                     window=EXPORT_READ_WORKERS * 2):
+    writer = PartitionWriter(output, event_type, day, file_format)
+    errors = 0
+    keys = list_day_keys(s3_client, bucket, event_type, day, key_prefix)
+    read = lambda object_key: s3_archiver.read_events(s3_client, bucket, object_key)
+    for lines in (read_ahead(pool, read, keys, window) if pool else map(read, keys)):
+        for line in lines:
+            try:
+                writer.add(event_codec.loads(line))
+            except ValueError:
+                errors += 1
+    writer.flush()
+    if errors:
+        print(f"Skipped {errors} undecodable {event_type} events for {day}")
+    return writer.rows, writer.files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export archived events from S3 to Parquet (or Arrow IPC) files")
+    parser.add_argument('--start', type=date.fromisoformat, required=True, help="first day to export (YYYY-MM-DD)")
+    parser.add_argument('--end', type=date.fromisoformat, help="last day to export (default: --start)")
+    parser.add_argument('--types', default=EVENT_TYPES, help="comma-separated event types to export")
+    parser.add_argument('--output', default=EXPORT_OUTPUT, help="local directory or s3://bucket/prefix")
+    parser.add_argument('--format', choices=('parquet', 'arrow'), default='parquet', help="output file format")
+    parser.add_argument('--bucket', default=S3_BUCKET_NAME, help="bucket holding the archived events")
+    parser.add_argument('--key-prefix', default='', help="extra prefix of the archived events (a rule's prefix)")
+    parser.add_argument('--workers', type=int, default=EXPORT_READ_WORKERS, help="archived objects downloaded concurrently")
+    args = parser.parse_args()
+
+    if pa is None:
+        raise SystemExit("pyarrow is required for exporting: pip install pyarrow")
+    if not args.bucket:
+        raise SystemExit("S3_BUCKET_NAME is missing in environment variables.")
+
+    s3_client = boto3.client('s3', region_name=S3_REGION, config=Config(max_pool_connections=max(10, args.workers)))
+    output = open_output(args.output, s3_client)
+    end = args.end or args.start
+    total = 0
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='export') as pool:
+        for event_type in [t.strip() for t in args.types.split(',') if t.strip()]:
+            day = args.start
+            while day <= end:
+                rows, files = export_partition(s3_client, args.bucket, output, event_type, day, args.format,
+                                               args.key_prefix, pool, args.workers * 2)
+                if rows:
+                    print(f"Exported {rows} {event_type} events for {day} in {files} file(s)")
+                total += rows
+                day += timedelta(days=1)
+    print(f"Exported {total} events to {args.output}")
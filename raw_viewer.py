@@ -1,38 +1,25 @@
 import os
 import json  # Import the json module
-import requests
 from dotenv import load_dotenv
 from sseclient import SSEClient
 from colorama import Fore, init
+import mra_client
 
 # Load environment variables and initialize colorama
 load_dotenv('production.env')
 init(autoreset=True)
 
 # Constants
-LOOKOUT_API_URL = 'https://api.lookout.com'
+LOOKOUT_API_URL = os.getenv('LOOKOUT_API_URL', 'https://api.lookout.com')
 TOKEN_URL = f'{LOOKOUT_API_URL}/oauth2/token'
 EVENTS_STREAM_URL = f'{LOOKOUT_API_URL}/mra/stream/v2/events'
 
-# Authentication function
-def get_access_token(application_key):
-    headers = {
-        'Authorization': f'Bearer {application_key}',
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    data = {
-        'grant_type': 'client_credentials'
-    }
-    response = requests.post(TOKEN_URL, headers=headers, data=data)
-    response.raise_for_status()  # Raise error for bad status
-    token_info = response.json()
-    return token_info['access_token'], token_info['expires_in']
-
 # Function to stream and process events with specific types
-def stream_and_process_events(access_token, event_types="THREAT,DEVICE,AUDIT"):
-    headers = {'Authorization': f'Bearer {access_token}', 'Accept': 'text/event-stream'}
+def stream_and_process_events(token_manager, event_types="THREAT,DEVICE,AUDIT"):
+    headers = {'Accept': 'text/event-stream'}
     params = {'types': event_types}  # Filter by specified event types
-    response = requests.get(EVENTS_STREAM_URL, headers=headers, params=params, stream=True)
+    response = mra_client.api_request('GET', EVENTS_STREAM_URL, token_manager, headers=headers, params=params,
+                                      stream=True, timeout=(mra_client.HTTP_TIMEOUT[0], None))
     response.raise_for_status()
     client = SSEClient(response)
     
@@ -91,9 +78,11 @@ if __name__ == "__main__":
     if not APPLICATION_KEY:
         raise ValueError("APPLICATION_KEY is missing in environment variables.")
     
-    access_token, expires_in = get_access_token(APPLICATION_KEY)
-    print(f"{Fore.BLUE}Obtained access token, expires in {expires_in} seconds.")
+    # raw_viewer does not use KeyDB, so only a file token cache applies
+    token_manager = mra_client.TokenManager(APPLICATION_KEY, TOKEN_URL, cache=mra_client.make_token_cache())
+    token_manager.get()
+    print(f"{Fore.BLUE}Obtained access token, expires in {token_manager.expires_in():.0f} seconds.")
     
     # Start streaming and processing events, filtering by specific event types
-    stream_and_process_events(access_token, event_types="THREAT,DEVICE,AUDIT")
+    stream_and_process_events(token_manager, event_types="THREAT,DEVICE,AUDIT")
 
@@ -0,0 +1,189 @@
+import os
+import gzip
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+import event_codec
+
+logger = logging.getLogger(__name__)
+
+# Batch limits (an open batch is flushed when any of these is reached)
+ARCHIVE_MAX_EVENTS = int(os.getenv('ARCHIVE_MAX_EVENTS', 5000))
+ARCHIVE_MAX_BYTES = int(os.getenv('ARCHIVE_MAX_BYTES', 8 * 1024 * 1024))  # 8 MB uncompressed
+ARCHIVE_MAX_AGE = float(os.getenv('ARCHIVE_MAX_AGE', 60))  # seconds
+ARCHIVE_CHECK_INTERVAL = 1.0  # seconds between age checks
+BATCH_PUT_ARGS = {'ContentType': 'application/x-ndjson', 'ContentEncoding': 'gzip'}
+
+
+# Function to parse the created_time of an event, falling back to the current time
+def parse_created_time(created_time):
+    if created_time:
+        try:
+            parsed = datetime.fromisoformat(created_time.replace('Z', '+00:00'))
+            if parsed.tzinfo is None:
+                parsed = parsed.replace(tzinfo=timezone.utc)
+            return parsed.astimezone(timezone.utc)
+        except (ValueError, AttributeError):
+            pass
+    return datetime.now(timezone.utc)
+
+
+# Function to build the partition prefix for an event
+def partition_prefix(event_type, created_time):
+    ts = parse_created_time(created_time)
+    return f"events/{event_type}/dt={ts:%Y-%m-%d}/hour={ts:%H}/"
+
+
+# Function to build a unique object key for a batch under a partition prefix
+def batch_object_key(prefix):
+    return f"{prefix}{int(time.time() * 1000)}-{uuid.uuid4().hex}.ndjson.gz"
+
+
+# Function to build the prefixes of the archived batches of an event type, one per day from
+# start to end (dates, inclusive)
+def day_prefixes(event_type, start, end, key_prefix=''):
+    prefixes = []
+    day = start
+    while day <= end:
+        prefixes.append(f"{key_prefix}events/{event_type}/dt={day:%Y-%m-%d}/")
+        day += timedelta(days=1)
+    return prefixes
+
+
+# Function to list the archived batch objects under a prefix
+def list_prefix_keys(s3_client, bucket, prefix):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.ndjson.gz'):
+                yield obj['Key']
+
+
+# Function to list the archived batch objects of an event type from start to end (dates)
+def list_batch_keys(s3_client, bucket, event_type, start, end, key_prefix=''):
+    for prefix in day_prefixes(event_type, start, end, key_prefix):
+        yield from list_prefix_keys(s3_client, bucket, prefix)
+
+
+# Function to read the events of one archived batch object, as raw JSON lines
+def read_batch(s3_client, bucket, object_key):
+    body = s3_client.get_object(Bucket=bucket, Key=object_key)['Body'].read()
+    return gzip.decompress(body).splitlines()
+
+
+# Function to build the prefixes of the per-event objects written before batching
+# (events/{type}/{created_time}_{actor guid}.json), one per day from start to end (dates)
+def legacy_day_prefixes(event_type, start, end, key_prefix=''):
+    prefixes = []
+    day = start
+    while day <= end:
+        prefixes.append(f"{key_prefix}events/{event_type}/{day:%Y-%m-%d}")
+        day += timedelta(days=1)
+    return prefixes
+
+
+# Function to list the legacy per-event objects under a prefix
+def list_legacy_keys(s3_client, bucket, prefix):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.json'):
+                yield obj['Key']
+
+
+# Function to read the events of an archived object, batch or legacy per-event, as raw JSON lines
+def read_events(s3_client, bucket, object_key):
+    if object_key.endswith('.ndjson.gz'):
+        return read_batch(s3_client, bucket, object_key)
+    body = s3_client.get_object(Bucket=bucket, Key=object_key)['Body'].read().strip()
+    return [body] if body else []
+
+
+# Collects events into per-partition batches and writes them as gzip'd NDJSON objects
+class S3BatchArchiver:
+    def __init__(self, uploader, max_events=ARCHIVE_MAX_EVENTS,
+                 max_bytes=ARCHIVE_MAX_BYTES, max_age=ARCHIVE_MAX_AGE, key_prefix=''):
+        self.uploader = uploader
+        self.key_prefix = key_prefix
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._batches = {}  # prefix -> {'lines': [...], 'size': int, 'opened': float}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._timer = None
+
+    # Add a single event to its partition batch, flushing the batch if it is full
+    def add(self, event):
+        self.add_raw(event.get('type', 'UNKNOWN'), event.get('created_time'), event_codec.dumps(event))
+
+    # Add an already encoded event (JSON bytes) without decoding it again
+    # route_prefix is inserted before the partition prefix (see event_rules), and
+    # on_stored() is called once the batch holding the event is uploaded.
+    def add_raw(self, event_type, created_time, raw, route_prefix='', on_stored=None):
+        prefix = self.key_prefix + route_prefix + partition_prefix(event_type, created_time)
+        line = raw + b'\n'
+        ready = None
+        with self._lock:
+            batch = self._batches.get(prefix)
+            if batch is None:
+                batch = {'lines': [], 'size': 0, 'opened': time.monotonic(), 'on_stored': []}
+                self._batches[prefix] = batch
+            batch['lines'].append(line)
+            batch['size'] += len(line)
+            if on_stored is not None:
+                batch['on_stored'].append(on_stored)
+            if len(batch['lines']) >= self.max_events or batch['size'] >= self.max_bytes:
+                ready = self._batches.pop(prefix)
+        if ready:
+            self._write(prefix, ready)
+
+    # Flush batches that have been open longer than max_age
+    def flush_expired(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [p for p, b in self._batches.items() if now - b['opened'] >= self.max_age]
+            ready = [(p, self._batches.pop(p)) for p in expired]
+        for prefix, batch in ready:
+            self._write(prefix, batch)
+
+    # Flush every open batch regardless of size or age
+    def flush_all(self):
+        with self._lock:
+            ready = list(self._batches.items())
+            self._batches.clear()
+        for prefix, batch in ready:
+            self._write(prefix, batch)
+
+    # Compress a batch and hand it to the upload pool as one object
+    def _write(self, prefix, batch):
+        object_key = batch_object_key(prefix)
+        body = gzip.compress(b''.join(batch['lines']))
+        callbacks = batch['on_stored']
+
+        def on_complete(uploaded):
+            if uploaded:
+                for on_stored in callbacks:
+                    on_stored()
+        self.uploader.submit(object_key, body, on_complete=on_complete if callbacks else None, **BATCH_PUT_ARGS)
+        logger.info(f"Queued batch of {len(batch['lines'])} events for S3: {object_key}")
+
+    # Start the background thread that enforces max_age
+    def start(self):
+        if self._timer is None:
+            self._timer = threading.Thread(target=self._run, name='s3-archiver', daemon=True)
+            self._timer.start()
+
+    def _run(self):
+        while not self._stop.wait(ARCHIVE_CHECK_INTERVAL):
+            self.flush_expired()
+
+    # Stop the age-check thread and flush everything that is still buffered
+    def close(self):
+        self._stop.set()
+        if self._timer is not None:
+            self._timer.join()
+            self._timer = None
+        self.flush_all()
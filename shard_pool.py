@@ -0,0 +1,178 @@
+import os
+import zlib
+import queue
+import logging
+import threading
+import collections
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+# Shard pool configuration
+SHARD_BATCH_EVENTS = int(os.getenv('SHARD_BATCH_EVENTS', 500))  # events per batch sent to a worker
+SHARD_BATCH_INTERVAL = float(os.getenv('SHARD_BATCH_INTERVAL', 0.05))  # seconds before a partial batch is sent
+SHARD_QUEUE_SIZE = int(os.getenv('SHARD_QUEUE_SIZE', 64))  # batches queued per worker before the reader blocks
+SHARD_ACK_INTERVAL = 1.0  # seconds between acknowledgement checks of an idle worker
+
+# Workers are started with "spawn" so they never inherit the reader's sockets or threads
+CONTEXT = multiprocessing.get_context('spawn')
+
+
+# Function to pick the shard of an event; every event of a device goes to the same worker
+def shard_for(key, shards):
+    if not key:
+        return 0
+    return zlib.crc32(key.encode('utf-8')) % shards
+
+
+# Function to build a stream payload from the raw JSON bytes of some events
+def encode_batch(raws):
+    return b'{"events":[' + b','.join(raws) + b']}'
+
+
+def _run_worker(shard, inbox, acks, setup, args):
+    process, close, acknowledged = setup(shard, *args)
+    last_acked = None
+
+    # Report the highest batch whose events are stored (and every earlier one)
+    def report():
+        nonlocal last_acked
+        seq = acknowledged()
+        if seq is not None and seq != last_acked:
+            acks.put((shard, seq))
+            last_acked = seq
+
+    try:
+        while True:
+            try:
+                item = inbox.get(timeout=SHARD_ACK_INTERVAL)
+            except queue.Empty:
+                report()
+                continue
+            if item is None:
+                return
+            seq, payload = item
+            process(seq, payload)
+            report()
+    finally:
+        close()
+        report()
+
+
+# Fans stream events out to worker processes, sharded by a key (the device GUID) so the
+# events of one device are always processed in order by the same worker.
+# Events are buffered per shard and sent as one payload per batch over a pipe; workers
+# acknowledge batches once their events are stored, and acknowledged() returns the last
+# stream event id whose events have all been stored, which is what the reader may checkpoint.
+# setup(shard, *args) runs in each worker and returns (process(seq, payload), close(),
+# acknowledged()), acknowledged returning the highest batch seq stored along with every
+# earlier one.
+class ShardPool:
+    def __init__(self, workers, setup, args=(), batch_events=SHARD_BATCH_EVENTS,
+                 batch_interval=SHARD_BATCH_INTERVAL, queue_size=SHARD_QUEUE_SIZE):
+        self.workers = workers
+        self.batch_events = batch_events
+        self.batch_interval = batch_interval
+        self._acks = CONTEXT.Queue()
+        self._inboxes = [CONTEXT.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._processes = [
+            CONTEXT.Process(target=_run_worker, args=(shard, inbox, self._acks, setup, args),
+                            name=f'shard-worker-{shard}')
+            for shard, inbox in enumerate(self._inboxes)
+        ]
+        self._buffers = [[] for _ in range(workers)]
+        self._sent = [0] * workers  # sequence number of the batch currently being buffered
+        self._acked = [-1] * workers  # highest batch sequence number acknowledged
+        self._pending = collections.deque()  # (event id, {shard: batch seq}) in stream order
+        self._last_acked_id = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = None
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+        self._flusher = threading.Thread(target=self._flush_periodically, name='shard-flusher', daemon=True)
+        self._flusher.start()
+        logger.info(f"Started {self.workers} shard workers")
+
+    # Queue the events of one stream message; items are (shard key, raw event JSON bytes)
+    # Blocks while a worker's queue is full (back-pressure on the stream reader).
+    def submit(self, event_id, items):
+        self._check_workers()
+        with self._lock:
+            needed = {}
+            for key, raw in items:
+                shard = shard_for(key, self.workers)
+                self._buffers[shard].append(raw)
+                needed[shard] = self._sent[shard]
+            self._pending.append((event_id, needed))
+            for shard in needed:
+                if len(self._buffers[shard]) >= self.batch_events:
+                    self._send(shard)
+
+    def _send(self, shard):
+        if not self._buffers[shard]:
+            return
+        payload = encode_batch(self._buffers[shard])
+        self._buffers[shard] = []
+        while True:
+            try:
+                self._inboxes[shard].put((self._sent[shard], payload), timeout=1.0)
+                break
+            except queue.Full:
+                self._check_workers()
+        self._sent[shard] += 1
+
+    def flush(self):
+        with self._lock:
+            for shard in range(self.workers):
+                self._send(shard)
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.batch_interval):
+            self.flush()
+
+    def _check_workers(self):
+        for process in self._processes:
+            if process.exitcode is not None:
+                raise RuntimeError(f"Shard worker {process.name} exited with code {process.exitcode}")
+
+    # Last stream event id whose events (and those of every earlier message) are processed
+    def acknowledged(self):
+        while True:
+            try:
+                shard, seq = self._acks.get_nowait()
+            except queue.Empty:
+                break
+            self._acked[shard] = max(self._acked[shard], seq)
+        with self._lock:
+            while self._pending:
+                event_id, needed = self._pending[0]
+                if any(self._acked[shard] < seq for shard, seq in needed.items()):
+                    break
+                self._pending.popleft()
+                if event_id:
+                    self._last_acked_id = event_id
+            return self._last_acked_id
+
+    # Send the buffered events, let every worker finish its queue, then stop the workers
+    def close(self):
+        self._stop.set()
+        if self._flusher:
+            self._flusher.join()
+        try:
+            self.flush()
+        except RuntimeError as e:
+            logger.error(f"Could not hand the last events to the shard workers: {str(e)}")
+        for inbox, process in zip(self._inboxes, self._processes):
+            if process.is_alive():
+                inbox.put(None)
+        for process in self._processes:
+            # Keep reading acknowledgements so a worker never blocks on a full ack pipe
+            while process.is_alive():
+                process.join(timeout=0.1)
+                self.acknowledged()
+            if process.exitcode:
+                logger.error(f"Shard worker {process.name} exited with code {process.exitcode}")
+        return self.acknowledged()
@@ -0,0 +1,208 @@
+import os
+import time
+import zlib
+import struct
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Spool configuration
+SPOOL_SEGMENT_BYTES = int(os.getenv('SPOOL_SEGMENT_BYTES', 64 * 1024 * 1024))  # 64 MB
+SPOOL_MAX_BYTES = int(os.getenv('SPOOL_MAX_BYTES', 10 * 1024 * 1024 * 1024))  # 10 GB
+SPOOL_FSYNC_INTERVAL = float(os.getenv('SPOOL_FSYNC_INTERVAL', 1.0))  # seconds
+
+# Every record is framed as <length><crc32><payload>
+RECORD_HEADER = struct.Struct('>II')
+SEGMENT_SUFFIX = '.wal'
+OFFSET_FILE = 'committed.offset'
+
+
+# Function to build the file name of a segment
+def segment_name(segment_id):
+    return f'{segment_id:012d}{SEGMENT_SUFFIX}'
+
+
+# Local append-only spool of segmented files. The writer appends records and fsyncs at
+# most every fsync_interval seconds; a single reader tails the spool and commits the
+# position up to which records have been durably handled. Committed segments are
+# deleted, and the oldest segments are dropped if the spool grows beyond max_bytes.
+class Spool:
+    def __init__(self, directory, segment_bytes=SPOOL_SEGMENT_BYTES, max_bytes=SPOOL_MAX_BYTES,
+                 fsync_interval=SPOOL_FSYNC_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._appended = threading.Condition(self._lock)
+        self.dropped_segments = 0
+        self.appended_records = 0
+        os.makedirs(directory, exist_ok=True)
+
+        segments = self._segments()
+        committed = self._load_offset()
+        if committed is None or committed[0] not in segments:
+            committed = (segments[0], 0) if segments else None
+        self._write_id = segments[-1] + 1 if segments else 1
+        self._committed = committed or (self._write_id, 0)
+        self._file = open(self._path(self._write_id), 'ab')
+        self._write_size = 0
+        self._last_fsync = time.monotonic()
+        self._read_pos = self._committed
+        self._read_file = None
+        self._read_file_id = None
+
+    def _path(self, segment_id):
+        return os.path.join(self.directory, segment_name(segment_id))
+
+    def _segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def _load_offset(self):
+        try:
+            with open(os.path.join(self.directory, OFFSET_FILE)) as f:
+                segment_id, offset = f.read().split()
+                return int(segment_id), int(offset)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    # Append one record; returns once it is written to the OS (fsync is batched)
+    def append(self, data):
+        header = RECORD_HEADER.pack(len(data), zlib.crc32(data))
+        with self._lock:
+            if self._write_size and self._write_size + len(data) > self.segment_bytes:
+                self._roll()
+            self._file.write(header)
+            self._file.write(data)
+            self._file.flush()
+            self._write_size += RECORD_HEADER.size + len(data)
+            self.appended_records += 1
+            if time.monotonic() - self._last_fsync >= self.fsync_interval:
+                os.fsync(self._file.fileno())
+                self._last_fsync = time.monotonic()
+            self._appended.notify_all()
+
+    # Force buffered records to disk
+    def sync(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._last_fsync = time.monotonic()
+
+    def _roll(self):
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._write_id += 1
+        self._file = open(self._path(self._write_id), 'ab')
+        self._write_size = 0
+        self._enforce_limit()
+
+    # Drop the oldest segments (even uncommitted ones) while the spool is over max_bytes
+    def _enforce_limit(self):
+        segments = self._segments()
+        total = sum(os.path.getsize(self._path(s)) for s in segments)
+        while total > self.max_bytes and len(segments) > 1 and segments[0] != self._write_id:
+            oldest = segments.pop(0)
+            size = os.path.getsize(self._path(oldest))
+            if self._read_file_id == oldest:
+                self._read_file.close()
+                self._read_file = self._read_file_id = None
+            os.remove(self._path(oldest))
+            total -= size
+            self.dropped_segments += 1
+            logger.error(f"Spool over {self.max_bytes} bytes, dropped segment {oldest} ({size} bytes)")
+            if self._committed[0] <= oldest:
+                self._committed = (segments[0], 0)
+                self._write_offset()
+            if self._read_pos[0] <= oldest:
+                self._read_pos = (segments[0], 0)
+
+    # Read the next record after the read position, waiting up to timeout for one
+    # Returns (data, position after the record) or None.
+    def read(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while True:
+                record = self._read_record()
+                if record is not None:
+                    return record
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._appended.wait(remaining)
+
+    def _read_record(self):
+        while True:
+            segment_id, offset = self._read_pos
+            if self._read_file_id != segment_id:
+                if self._read_file:
+                    self._read_file.close()
+                self._read_file = self._read_file_id = None
+                if not os.path.exists(self._path(segment_id)):
+                    if segment_id >= self._write_id:
+                        return None
+                    self._read_pos = (segment_id + 1, 0)
+                    continue
+                self._read_file = open(self._path(segment_id), 'rb')
+                self._read_file_id = segment_id
+            self._read_file.seek(offset)
+            header = self._read_file.read(RECORD_HEADER.size)
+            if len(header) == RECORD_HEADER.size:
+                length, crc = RECORD_HEADER.unpack(header)
+                data = self._read_file.read(length)
+                if len(data) == length and zlib.crc32(data) == crc:
+                    self._read_pos = (segment_id, offset + RECORD_HEADER.size + length)
+                    return data, self._read_pos
+                if segment_id == self._write_id:
+                    return None
+                logger.error(f"Spool segment {segment_id} is corrupt at offset {offset}, skipping the rest")
+            elif segment_id == self._write_id:
+                return None
+            # End of a finished (or torn) segment: continue with the next one
+            self._read_pos = (segment_id + 1, 0)
+
+    # Mark everything up to position as handled and delete fully committed segments
+    def commit(self, position):
+        with self._lock:
+            self._committed = position
+            self._write_offset()
+            for segment_id in self._segments():
+                if segment_id < position[0] and segment_id != self._read_file_id:
+                    os.remove(self._path(segment_id))
+
+    def _write_offset(self):
+        path = os.path.join(self.directory, OFFSET_FILE)
+        with open(f'{path}.tmp', 'w') as f:
+            f.write(f'{self._committed[0]} {self._committed[1]}')
+        os.replace(f'{path}.tmp', path)
+
+    # Move the read position back to the last commit, so uncommitted records are replayed
+    def rewind(self):
+        with self._lock:
+            self._read_pos = self._committed
+
+    # Bytes written but not yet committed (the spool lag), plus segment counters
+    def stats(self):
+        with self._lock:
+            segments = self._segments()
+            total = sum(os.path.getsize(self._path(s)) for s in segments)
+            committed_segment, committed_offset = self._committed
+            lag = sum(os.path.getsize(self._path(s)) for s in segments if s >= committed_segment)
+            lag -= committed_offset if committed_segment in segments else 0
+            return {
+                'segments': len(segments),
+                'bytes': total,
+                'lag_bytes': max(lag, 0),
+                'appended_records': self.appended_records,
+                'dropped_segments': self.dropped_segments,
+            }
+
+    def close(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            if self._read_file:
+                self._read_file.close()
@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import threading
+from contextlib import nullcontext
+
+# SQLite store configuration
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))  # bytes of the file read through mmap
+SQLITE_BUSY_TIMEOUT = 30000  # ms a writer waits for another process's write to finish
+SQLITE_MAX_VARIABLES = 500  # keys per SELECT ... IN (...) of an MGET
+
+WRITE_COMMANDS = frozenset(('set', 'mset', 'delete'))
+
+SCHEMA = 'CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID'
+
+
+# Commands queued by SQLiteStore.pipeline(); execute() runs them in one transaction if any
+# of them writes (reads alone never take the write lock)
+class _Pipeline:
+    def __init__(self, store):
+        self.store = store
+        self._commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        commands, self._commands = self._commands, []
+        writes = any(name in WRITE_COMMANDS for name, _, _ in commands)
+        with self.store.transaction() if writes else nullcontext():
+            return [getattr(self.store, name)(*args, **kwargs) for name, args, kwargs in commands]
+
+
+# Key/value store in a local SQLite file, implementing the subset of the KeyDB client API
+# that device_store uses (get, mget, set, mset, delete and pipeline), so the viewers can
+# enrich events from a file on the same host instead of over the network.
+# The file is read through mmap and opened in WAL mode: opening it is instant, lookups
+# are in-process, and any number of processes can read it while one of them writes.
+# Values are returned as they were stored (str or bytes); key expiry is not supported.
+class SQLiteStore:
+    def __init__(self, path, mmap_size=SQLITE_MMAP_SIZE):
+        self.path = path
+        self.mmap_size = mmap_size
+        self._local = threading.local()  # one connection per thread
+        self.connection().execute(SCHEMA)
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT / 1000, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    # Context manager grouping the writes of its block into one transaction
+    def transaction(self):
+        return _Transaction(self)
+
+    def get(self, key):
+        row = self.connection().execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def mget(self, keys, *args):
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+        keys += args
+        conn = self.connection()
+        found = {}
+        for i in range(0, len(keys), SQLITE_MAX_VARIABLES):
+            chunk = keys[i:i + SQLITE_MAX_VARIABLES]
+            query = f"SELECT key, value FROM kv WHERE key IN ({','.join('?' * len(chunk))})"
+            found.update(conn.execute(query, chunk))
+        return [found.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        with self.transaction():
+            self.connection().execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key, _value(value)))
+        return True
+
+    def mset(self, mapping):
+        with self.transaction():
+            self.connection().executemany('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)',
+                                          [(key, _value(value)) for key, value in mapping.items()])
+        return True
+
+    def delete(self, *keys):
+        with self.transaction():
+            cursor = self.connection().executemany('DELETE FROM kv WHERE key = ?', [(key,) for key in keys])
+        return cursor.rowcount
+
+    def pipeline(self, transaction=False):
+        return _Pipeline(self)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+# Numbers are stored as text, like KeyDB does
+def _value(value):
+    return value if isinstance(value, (str, bytes)) else str(value)
+
+
+# BEGIN IMMEDIATE ... COMMIT around the outermost block of a thread (nested blocks join it)
+class _Transaction:
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        conn = self.store.connection()
+        if self.store._local.depth == 0:
+            conn.execute('BEGIN IMMEDIATE')
+        self.store._local.depth += 1
+        return conn
+
+    def __exit__(self, exc_type, exc, tb):
+        local = self.store._local
+        local.depth -= 1
+        if local.depth == 0:
+            local.conn.execute('COMMIT' if exc_type is None else 'ROLLBACK')
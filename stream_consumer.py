@@ -0,0 +1,191 @@
+import os
+import time
+import random
+import logging
+import functools
+import threading
+import collections
+import requests
+from sseclient import SSEClient
+import metrics
+import mra_client
+
+logger = logging.getLogger(__name__)
+
+# Stream consumer configuration
+RECONNECT_BACKOFF_BASE = 1.0  # seconds
+RECONNECT_BACKOFF_CAP = 60.0  # seconds
+STREAM_CONNECT_TIMEOUT = 10  # seconds
+STREAM_READ_TIMEOUT = 90  # seconds without data (heartbeats included) before reconnecting
+CHECKPOINT_INTERVAL = 1.0  # seconds between checkpoint writes
+STREAM_CHECKPOINT = os.getenv('STREAM_CHECKPOINT', 'stream.checkpoint')  # file path, or "keydb"
+STREAM_CHECKPOINT_KEY = os.getenv('STREAM_CHECKPOINT_KEY', 'stream:last_event_id')
+
+# Stream metrics
+STREAM_MESSAGES = metrics.Counter('stream_messages_total', 'SSE messages received, by event name', ['event'])
+STREAM_RECONNECTS = metrics.Counter('stream_reconnects_total', 'Reconnections to the event stream')
+STREAM_ERRORS = metrics.Counter('stream_errors_total', 'Event stream connection or read errors')
+
+
+# Stores the last processed SSE event id in a local file
+class FileCheckpoint:
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def save(self, event_id):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(event_id)
+        os.replace(tmp_path, self.path)
+
+
+# Stores the last processed SSE event id in a KeyDB key
+class RedisCheckpoint:
+    def __init__(self, r, key=STREAM_CHECKPOINT_KEY):
+        self.r = r
+        self.key = key
+
+    def load(self):
+        return self.r.get(self.key)
+
+    def save(self, event_id):
+        self.r.set(self.key, event_id)
+
+
+# Tracks which stream messages are stored, so the checkpoint never passes an event that is
+# still buffered in memory. A message is pending from begin() until its ticket's done() is
+# called and every release function handed out by ticket.hold() (one per event given to the
+# archiver, called once the event's batch is uploaded) has been called.
+# acknowledged() returns the id of the last message that, like every earlier one, is stored.
+class PendingMessages:
+    def __init__(self):
+        self._pending = collections.deque()  # [message id, outstanding holds] in stream order
+        self._last_acked_id = None
+        self._lock = threading.Lock()
+
+    def begin(self, message_id):
+        entry = [message_id, 1]
+        with self._lock:
+            self._pending.append(entry)
+        return MessageTicket(self, entry)
+
+    def _release(self, entry):
+        with self._lock:
+            entry[1] -= 1
+
+    def acknowledged(self):
+        with self._lock:
+            while self._pending and self._pending[0][1] <= 0:
+                message_id = self._pending.popleft()[0]
+                if message_id is not None:
+                    self._last_acked_id = message_id
+            return self._last_acked_id
+
+
+# One message's share of PendingMessages
+class MessageTicket:
+    def __init__(self, messages, entry):
+        self._messages = messages
+        self._entry = entry
+
+    # Count one more event of the message that is not stored yet; returns its release function
+    def hold(self):
+        with self._messages._lock:
+            self._entry[1] += 1
+        return functools.partial(self._messages._release, self._entry)
+
+    # The message is processed: only its held events keep it pending
+    def done(self):
+        self._messages._release(self._entry)
+
+
+# Function to build the checkpoint store selected by STREAM_CHECKPOINT
+def make_checkpoint(r=None):
+    if STREAM_CHECKPOINT == 'keydb':
+        return RedisCheckpoint(r)
+    return FileCheckpoint(STREAM_CHECKPOINT)
+
+
+# Function to consume the event stream forever, reconnecting with backoff and resuming
+# from the checkpointed event id. handle_event is called with every SSE event.
+# If events are not stored by the time handle_event returns (they are buffered for S3, or
+# queued for processing elsewhere), pass acknowledged: a callable returning the last event
+# id that is fully stored (e.g. PendingMessages.acknowledged), which is then what gets
+# checkpointed instead of the last event id received.
+def consume_events(stream_url, token_manager, handle_event, checkpoint=None, params=None, acknowledged=None):
+    last_event_id = checkpoint.load() if checkpoint else None
+    if last_event_id:
+        logger.info(f"Resuming stream from event id {last_event_id}")
+    saved_event_id = last_event_id
+    last_saved = time.monotonic()
+    failures = 0
+    reconnects = 0
+
+    while True:
+        server_delay = None
+        try:
+            headers = {'Authorization': f'Bearer {token_manager.get()}', 'Accept': 'text/event-stream'}
+            if last_event_id:
+                headers['Last-Event-ID'] = last_event_id
+            # The shared session keeps the connection alive across reconnects
+            response = mra_client.shared_session.get(stream_url, headers=headers, params=params, stream=True,
+                                                     timeout=(STREAM_CONNECT_TIMEOUT, STREAM_READ_TIMEOUT))
+            if response.status_code == 401:
+                token_manager.invalidate()
+            elif response.status_code in mra_client.RETRY_STATUSES:
+                server_delay = mra_client.retry_after(response)
+            received = 0
+            try:
+                response.raise_for_status()
+                client = SSEClient(response)
+                for event in client.events():
+                    STREAM_MESSAGES.inc(event=event.event)
+                    handle_event(event)
+                    if event.event != 'heartbeat':
+                        received += 1
+                        failures = 0
+                    if event.id:
+                        last_event_id = event.id
+                    if checkpoint and time.monotonic() - last_saved >= CHECKPOINT_INTERVAL:
+                        done_event_id = acknowledged() if acknowledged else last_event_id
+                        if done_event_id and done_event_id != saved_event_id:
+                            checkpoint.save(done_event_id)
+                            saved_event_id = done_event_id
+                        last_saved = time.monotonic()
+                    # Reconnect with a fresh token before the current one expires
+                    if token_manager.remaining() <= 0:
+                        logger.info("Access token about to expire, reconnecting with a new token")
+                        break
+                else:
+                    logger.warning("Event stream closed by server")
+                    if not received:
+                        failures += 1
+            finally:
+                response.close()
+        except requests.RequestException as e:
+            failures += 1
+            STREAM_ERRORS.inc()
+            logger.error(f"Event stream error: {str(e)}")
+        finally:
+            done_event_id = (acknowledged() if acknowledged else last_event_id) if checkpoint else None
+            if done_event_id and done_event_id != saved_event_id:
+                checkpoint.save(done_event_id)
+                saved_event_id, last_saved = done_event_id, time.monotonic()
+
+        reconnects += 1
+        STREAM_RECONNECTS.inc()
+        if failures:
+            delay = random.uniform(0, min(RECONNECT_BACKOFF_CAP, RECONNECT_BACKOFF_BASE * 2 ** failures))
+            if server_delay is not None:
+                delay = max(delay, server_delay)  # the server's Retry-After
+            logger.info(f"Reconnecting to event stream in {delay:.1f}s (attempt {failures}, reconnect #{reconnects})")
+            time.sleep(delay)
+        else:
+            logger.info(f"Reconnecting to event stream (reconnect #{reconnects})")
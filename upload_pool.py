@@ -0,0 +1,160 @@
+import os
+import time
+import queue
+import random
+import logging
+import threading
+import boto3
+from botocore.config import Config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Upload pool configuration
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 4))
+UPLOAD_QUEUE_SIZE = int(os.getenv('UPLOAD_QUEUE_SIZE', 64))
+UPLOAD_MAX_RETRIES = int(os.getenv('UPLOAD_MAX_RETRIES', 5))
+UPLOAD_BACKOFF_BASE = 0.5  # seconds
+UPLOAD_BACKOFF_CAP = 30.0  # seconds
+UPLOAD_METRICS_INTERVAL = float(os.getenv('UPLOAD_METRICS_INTERVAL', 60))  # seconds, 0 disables
+
+# Upload metrics (shared by every pool in the process)
+S3_UPLOADS = metrics.Counter('s3_uploads_total', 'S3 objects uploaded, by result', ['result'])
+S3_UPLOAD_RETRIES = metrics.Counter('s3_upload_retries_total', 'S3 upload attempts that were retried')
+S3_UPLOAD_BYTES = metrics.Counter('s3_upload_bytes_total', 'Bytes uploaded to S3')
+S3_UPLOAD_SECONDS = metrics.Histogram('s3_upload_seconds', 'Latency of successful S3 put_object calls')
+S3_BLOCKED_SUBMITS = metrics.Counter('s3_upload_blocked_submits_total', 'Submits that waited on a full upload queue')
+
+
+# Function to create an S3 client whose connection pool is sized for the worker pool
+def make_s3_client(region_name, workers=UPLOAD_WORKERS):
+    config = Config(max_pool_connections=max(10, workers), retries={'max_attempts': 1, 'mode': 'standard'})
+    return boto3.client('s3', region_name=region_name, config=config)
+
+
+# Bounded queue of S3 writes drained by a pool of worker threads sharing one client
+class UploadPool:
+    def __init__(self, s3_client, bucket_name, workers=UPLOAD_WORKERS, queue_size=UPLOAD_QUEUE_SIZE,
+                 max_retries=UPLOAD_MAX_RETRIES, metrics_interval=UPLOAD_METRICS_INTERVAL):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.workers = workers
+        self.max_retries = max_retries
+        self.metrics_interval = metrics_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._stop = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'uploaded': 0,
+            'failed': 0,
+            'retries': 0,
+            'blocked_submits': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+        }
+
+    # Start the worker threads (and the periodic metrics reporter)
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f's3-upload-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.metrics_interval > 0:
+            threading.Thread(target=self._report, name='s3-upload-metrics', daemon=True).start()
+
+    # Queue an object for upload; blocks while the queue is full (back-pressure)
+    # on_complete(uploaded) is called on the worker thread once the upload succeeded or failed.
+    def submit(self, object_key, body, on_complete=None, **put_kwargs):
+        item = (object_key, body, put_kwargs, on_complete)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats['blocked_submits'] += 1
+            S3_BLOCKED_SUBMITS.inc()
+            logger.warning(f"Upload queue full ({self._queue.maxsize}), waiting for workers", extra={'rate_key': 'upload_queue_full'})
+            self._queue.put(item)
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                object_key, body, put_kwargs, on_complete = item
+                uploaded = self._upload(object_key, body, put_kwargs)
+                if on_complete is not None:
+                    try:
+                        on_complete(uploaded)
+                    except Exception as e:
+                        logger.error(f"Error in upload callback for {object_key}: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    # Upload one object, retrying with full-jitter exponential backoff
+    def _upload(self, object_key, body, put_kwargs):
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            try:
+                self.s3_client.put_object(Bucket=self.bucket_name, Key=object_key, Body=body, **put_kwargs)
+                elapsed = time.monotonic() - start
+                with self._stats_lock:
+                    self._stats['uploaded'] += 1
+                    self._stats['latency_total'] += elapsed
+                    self._stats['latency_max'] = max(self._stats['latency_max'], elapsed)
+                S3_UPLOADS.inc(result='uploaded')
+                S3_UPLOAD_BYTES.inc(len(body))
+                S3_UPLOAD_SECONDS.observe(elapsed)
+                logger.info(f"Successfully uploaded data to S3: {object_key} ({elapsed * 1000:.0f} ms)")
+                return True
+            except Exception as e:
+                if attempt == self.max_retries:
+                    with self._stats_lock:
+                        self._stats['failed'] += 1
+                    S3_UPLOADS.inc(result='failed')
+                    logger.error(f"Error uploading to S3 ({object_key}) after {attempt + 1} attempts: {str(e)}")
+                    return False
+                delay = random.uniform(0, min(UPLOAD_BACKOFF_CAP, UPLOAD_BACKOFF_BASE * 2 ** attempt))
+                with self._stats_lock:
+                    self._stats['retries'] += 1
+                S3_UPLOAD_RETRIES.inc()
+                logger.warning(f"Error uploading to S3 ({object_key}), retrying in {delay:.2f}s: {str(e)}")
+                time.sleep(delay)
+
+    # Block until every queued upload has finished (successfully or not)
+    def wait_idle(self):
+        self._queue.join()
+
+    # Snapshot of queue depth and upload latency counters
+    def metrics(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        latency_total = stats.pop('latency_total')
+        stats['queue_depth'] = self._queue.qsize()
+        stats['latency_avg'] = (latency_total / stats['uploaded']) if stats['uploaded'] else 0.0
+        return stats
+
+    def _report(self):
+        while not self._stop.wait(self.metrics_interval):
+            self.log_metrics()
+
+    def log_metrics(self):
+        m = self.metrics()
+        logger.info(
+            f"Upload pool - queue depth: {m['queue_depth']}, uploaded: {m['uploaded']}, failed: {m['failed']}, "
+            f"retries: {m['retries']}, blocked submits: {m['blocked_submits']}, "
+            f"latency avg: {m['latency_avg'] * 1000:.0f} ms, max: {m['latency_max'] * 1000:.0f} ms"
+        )
+
+    # Drain everything that is queued, then stop the workers
+    def close(self):
+        self._stop.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.log_metrics()